@@ -0,0 +1,318 @@
+import json
+import logging
+import os
+import platform
+import socket
+import tempfile
+import numpy as np
+from select import select
+from threading import Thread
+from time import time, perf_counter_ns, sleep
+import FC4D_CameraGrabber as grabber
+import FC4D_Reconstructor as recon
+import FC4D_SimCamera as sim
+from FC4D_Calibration import decompose
+from FC4D_Display import DisplayMapper
+from FC4D_Protocol import FrameNote, NotificationParser, parse_active_file
+from FC4D_Reconstructor import TikhonovEngine
+from FC4D_Server import FrameServer
+from FC4D_SharedFrames import FrameRing
+
+# Runs the grabber's grab thread, ring and FrameServer on the simulated camera at fixed frame rates and sizes, with
+# plain subscribers, a reconstructor and a display as its clients, and writes per stage throughput, p50/p99
+# latency and dropped frames to a JSON file
+
+BENCH_PORT = 0xFC4D + 16
+
+
+def summarise(samples_ns, dropped: int, delivered=None):
+    # Throughput of a stage is what it could sustain on its own, one over its mean time per frame; for the end
+    # to end figure, where the samples are latencies, it is the rate frames were delivered at instead
+    arr = np.asarray(samples_ns, dtype='float64') / 1e6
+    if len(arr) == 0:
+        return {'frames': 0, 'throughput_fps': 0.0, 'p50_ms': None, 'p99_ms': None, 'mean_ms': None,
+                'dropped': dropped}
+    mean = float(arr.mean())
+    return {'frames': len(arr), 'throughput_fps': delivered if delivered is not None else 1e3 / max(mean, 1e-9),
+            'p50_ms': float(np.percentile(arr, 50)), 'p99_ms': float(np.percentile(arr, 99)), 'mean_ms': mean,
+            'dropped': dropped}
+
+
+def display_frame(mapper: DisplayMapper, frame, size):
+    # Same conversion as Window.render_frame: the mapper already puts out the window's size
+    from PIL import Image
+    mapper.set_target(size)
+    img = mapper.map(frame)
+    return Image.frombuffer('L', (img.shape[1], img.shape[0]), img, 'raw', 'L', 0, 1)
+
+
+def run_batch(width: int, height: int, scene_scale: int, frames: int, repeats=3):
+    # Offline reconstruction of a stack through TikhonovEngine.process_batch; best of repeats
+    rng = np.random.default_rng(0)
+    engine = TikhonovEngine(decompose(rng.random((height, height // scene_scale)),
+                                      rng.random((width, width // scene_scale))), 1e-2)
+    stack = rng.integers(0, 4096, (frames, height, width)).astype('uint16')
+    out = np.empty((frames, ) + engine.sceneShape, dtype=engine.dType)
+    engine.process_batch(stack[:1], out[:1])
+    batch = None
+    for _r in range(repeats):
+        start = perf_counter_ns()
+        engine.process_batch(stack, out)
+        duration = perf_counter_ns() - start
+        batch = duration if batch is None else min(batch, duration)
+    return {'width': width, 'height': height, 'scene': list(engine.sceneShape), 'frames': frames,
+            'batch_fps': frames * 1e9 / batch}
+
+
+class Subscriber:
+    # A client of the grabber's FrameServer like any other; it maps the ring named in the ActiveFile line, counts
+    # the frames it was never told about from gaps in the sequence numbers and times each notification from the
+    # host time the grabber stamped into the ring
+
+    def __init__(self, port: int, options=''):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.sock.send(('framedonotify:binary' + options + '\n').encode('utf-8'))
+        self.sock.setblocking(False)
+        self.parser = NotificationParser()
+        self.ring = None
+        self.lastSeq = 0
+        self.received = 0
+        self.gaps = 0
+        self.samples = []
+        self.running = True
+        self.thread = Thread(target=self.run)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            r, _w, _e = select([self.sock, ], [], [], 0.05)
+            if not r:
+                continue
+            try:
+                data = self.sock.recv(65536)
+            except BlockingIOError:
+                continue
+            notes = []
+            for event in self.parser.feed(data):
+                if isinstance(event, FrameNote):
+                    notes.append(event)
+                elif 'ActiveFile' in event:
+                    if self.ring is not None:
+                        self.ring.close()
+                    self.ring = FrameRing(parse_active_file(event)[0])
+            if notes and self.ring is not None:
+                for note in notes:
+                    self.received += 1
+                    if self.lastSeq > 0:
+                        self.gaps += max(0, note.seq - self.lastSeq - 1)
+                    self.lastSeq = max(self.lastSeq, note.seq)
+                self.handle(notes)
+
+    def handle(self, notes):
+        now = time()
+        for note in notes:
+            _timestamp, host_time = self.ring.info(note.seq)
+            if self.ring.valid(note.seq):
+                self.samples.append((now - host_time) * 1e9)
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        self.sock.close()
+        if self.ring is not None:
+            self.ring.close()
+
+
+class ReconstructorSubscriber(Subscriber):
+    # Newest frame only, through the same reconstruct() as the Reconstructor's main loop
+
+    def __init__(self, port: int, engine):
+        self.torn = 0
+        self.skipped = 0
+        self.lastDone = 0
+        # The Reconstructor's globals, as its main loop sets them up once the ActiveFile line is in
+        recon.MMFile = None
+        recon.engine = engine
+        recon.frameStats = recon.FrameStats()
+        recon.output = None
+        Subscriber.__init__(self, port, ':latest')
+
+    def handle(self, notes):
+        if recon.MMFile is None:
+            recon.MMFile = self.ring
+        note = recon.newest_frame(notes[-1])
+        if note is None:
+            return
+        start = perf_counter_ns()
+        if recon.reconstruct(note) is None:
+            self.torn += 1
+        self.samples.append(perf_counter_ns() - start)
+
+    def close(self):
+        Subscriber.close(self)
+        self.skipped = recon.frameStats.skipped
+        self.lastDone = recon.frameStats.lastSeq
+        recon.MMFile = None
+        recon.engine = None
+
+
+class DisplaySubscriber(Subscriber):
+    # Newest frame only, converted like Window.render_frame; also where a frame's trip from the
+    # camera ends
+
+    def __init__(self, port: int, size, bits=12):
+        self.size = size
+        self.mapper = DisplayMapper(bits)
+        self.havePil = True
+        self.latencies = []
+        self.torn = 0
+        Subscriber.__init__(self, port, ':latest')
+
+    def handle(self, notes):
+        note = notes[-1]
+        frame = self.ring.view(note.seq)
+        if frame is None:
+            self.torn += 1
+            return
+        start = perf_counter_ns()
+        if self.havePil:
+            try:
+                display_frame(self.mapper, frame, self.size)
+            except ImportError:
+                self.havePil = False
+        if not self.havePil:
+            self.mapper.set_target(self.size)
+            self.mapper.map(frame)
+        end = perf_counter_ns()
+        self.samples.append(end - start)
+        # The simulated camera stamps frames on the perf_counter_ns clock, so this is photon to pixel
+        self.latencies.append(end - note.timestamp)
+
+
+def run_config(width: int, height: int, fps: float, frames: int, subscribers: int, scene_scale: int,
+               display_size, workdir: str):
+    # The grabber's own camera, grab thread, ring and FrameServer, with plain subscribers, a reconstructor and a
+    # display as clients of it
+    sim.configure(width=width, height=height, fps=fps, pixelFormat='Mono12', replay=None, devices=1)
+    grabber.py = sim
+    grabber.genicam = sim
+    # A directory of its own, so the ring starts at sequence 0 and not where the last configuration left it
+    cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp(dir=workdir))
+    try:
+        grabber.pyCams = grabber.enumerate_cams(8, False)
+        pycam = next(iter(grabber.pyCams.values()))
+        pycam.open_cam()
+    finally:
+        os.chdir(cwd)
+
+    rng = np.random.default_rng(0)
+    phi_l = rng.random((height, height // scene_scale))
+    phi_r = rng.random((width, width // scene_scale))
+    engine = TikhonovEngine(decompose(phi_l, phi_r), 1e-2)
+
+    server = FrameServer(('127.0.0.1', BENCH_PORT), grabber.parse_message, grabber.rem_image_client, 4)
+    pycam.server = server
+    stop = [False]
+    server_thread = Thread(target=server.serve, args=(lambda: stop[0], ))
+    server_thread.start()
+    subs = [Subscriber(BENCH_PORT) for _i in range(subscribers)]
+    reconstructor = ReconstructorSubscriber(BENCH_PORT, engine)
+    display = DisplaySubscriber(BENCH_PORT, display_size)
+    while len(pycam.imageClients) < subscribers + 2:
+        sleep(0.01)
+
+    start = perf_counter_ns()
+    grabber.start_grabbing(pycam)
+    while pycam.grabber.is_alive() and pycam.ring.writeSeq < frames:
+        sleep(0.005)
+    grabber.stop_grabbing(pycam)
+    duration = (perf_counter_ns() - start) / 1e9
+    grabbed = pycam.ring.latest_seq()
+
+    sleep(0.2)
+    names = [s.sock.getsockname() for s in subs]
+    queue_dropped = sum([c.dropped for c in pycam.imageClients if c.peername in names])
+    stop[0] = True
+    server.wake()
+    server_thread.join()
+    for s in subs + [reconstructor, display]:
+        s.close()
+    server.close()
+    pycam.release_cam()
+
+    copy = pycam.stats['copy']
+    copy_ns = copy.samples[:min(copy.count, len(copy.samples))]
+    fanout = summarise([t for s in subs for t in s.samples], sum([s.gaps + grabbed - s.lastSeq for s in subs]))
+    fanout['queue_dropped'] = queue_dropped
+    stages = {'grab_copy': summarise(copy_ns, int(pycam.dropped)),
+              'notify_fanout': fanout,
+              'reconstruct': summarise(reconstructor.samples,
+                                       reconstructor.skipped + reconstructor.torn + grabbed - reconstructor.lastDone),
+              'display': summarise(display.samples, display.gaps + display.torn + grabbed - display.lastSeq)
+              if display.havePil else None,
+              'end_to_end': summarise(display.latencies, int(pycam.dropped) + grabbed - len(display.latencies),
+                                      len(display.latencies) / duration if duration > 0 else 0.0)}
+    return {'width': width, 'height': height, 'fps': fps, 'frames': grabbed, 'subscribers': subscribers,
+            'scene': [height // scene_scale, width // scene_scale], 'display': list(display_size), 'stages': stages}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-l', '--log_level', help='Specify log verbosity')
+    parser.add_argument('--sizes', default='640x480,1280x1024', help='Comma separated sensor sizes, WxH')
+    parser.add_argument('--fps', default='30,100', help='Comma separated frame rates')
+    parser.add_argument('--subscribers', default='1,8', help='Comma separated subscriber counts')
+    parser.add_argument('--frames', type=int, default=200, help='Frames per configuration')
+    parser.add_argument('--scene_scale', type=int, default=4, help='Sensor to scene size ratio of the calibration')
+    parser.add_argument('--display', default='640x480', help='Display size for the GUI stage, WxH')
+    parser.add_argument('--batch_sizes', default='80x60,160x120,320x240,640x480',
+                        help='Comma separated sensor sizes, WxH, to time offline reconstruction at')
+    parser.add_argument('--batch_frames', type=int, default=128, help='Frames per offline batch')
+    parser.add_argument('-o', '--output', default='FC4D_Benchmark.json', help='Machine readable results')
+
+    args = parser.parse_args()
+    if args.log_level:
+        if 'critical' in args.log_level:
+            logging.basicConfig(level=logging.CRITICAL)
+        elif 'error' in args.log_level:
+            logging.basicConfig(level=logging.ERROR)
+        elif 'warning' in args.log_level:
+            logging.basicConfig(level=logging.WARNING)
+        elif 'info' in args.log_level:
+            logging.basicConfig(level=logging.INFO)
+        elif 'debug' in args.log_level:
+            logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.WARNING)
+
+    dw, dh = args.display.lower().split('x')
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in args.sizes.split(','):
+            w, h = size.lower().split('x')
+            for fps in args.fps.split(','):
+                for n in args.subscribers.split(','):
+                    res = run_config(int(w), int(h), float(fps), args.frames, int(n), args.scene_scale,
+                                     (int(dw), int(dh)), workdir)
+                    results.append(res)
+                    e2e = res['stages']['end_to_end']
+                    print(size + ' @ ' + fps + ' FPS, ' + n + ' subscribers: ' +
+                          str(round(e2e['throughput_fps'], 1)) + ' FPS, p50 ' + str(round(e2e['p50_ms'] or 0, 2)) +
+                          ' ms, p99 ' + str(round(e2e['p99_ms'] or 0, 2)) + ' ms, dropped ' + str(e2e['dropped']) +
+                          ', reconstructed ' +
+                          str(round(res['stages']['reconstruct']['throughput_fps'], 1)) + ' FPS at most')
+
+    batches = []
+    for size in args.batch_sizes.split(','):
+        w, h = size.lower().split('x')
+        res = run_batch(int(w), int(h), args.scene_scale, args.batch_frames)
+        batches.append(res)
+        print(size + ' batch of ' + str(res['frames']) + ': ' + str(round(res['batch_fps'], 1)) + ' FPS')
+
+    with open(args.output, 'w') as f:
+        json.dump({'time': time(), 'host': platform.node(), 'python': platform.python_version(),
+                   'numpy': np.__version__, 'results': results, 'batch': batches}, f, indent=2)
+    print('Results written to ' + os.path.abspath(args.output))
@@ -0,0 +1,166 @@
+import glob
+import json
+import logging
+import os
+import re
+import shutil
+import numpy as np
+
+CACHE_VERSION = 1
+FACTOR_NAMES = ('UL', 'SL', 'VL', 'UR', 'SR', 'VR')
+
+
+def load_calibration(path: str):
+    if os.path.isdir(path):
+        # A calibration cache directory
+        return np.load(os.path.join(path, 'PhiL.npy')), np.load(os.path.join(path, 'PhiR.npy'))
+    with np.load(path) as calib:
+        phi_l = np.array(calib['PhiL'], dtype='float64')
+        phi_r = np.array(calib['PhiR'], dtype='float64')
+    return phi_l, phi_r
+
+
+def decompose(phi_l, phi_r):
+    u_l, s_l, vt_l = np.linalg.svd(phi_l, full_matrices=False)
+    u_r, s_r, vt_r = np.linalg.svd(phi_r, full_matrices=False)
+    return {'UL': u_l, 'SL': s_l, 'VL': vt_l.T, 'UR': u_r, 'SR': s_r, 'VR': vt_r.T}
+
+
+def tikhonov_filter(s_l, s_r, lmbd):
+    sigma = np.outer(s_l, s_r)
+    return sigma / (np.square(sigma) + lmbd)
+
+
+def binning_factor(full_shape, shape):
+    # The whole factor a full_shape sensor is binned by to give shape (1 if they are equal), 0 if there is none
+    factor = full_shape[0] // shape[0] if shape[0] > 0 else 0
+    if factor < 1 or full_shape[0] // factor != shape[0] or full_shape[1] // factor != shape[1]:
+        return 0
+    return factor
+
+
+def bin_calibration(phi, factor: int):
+    # Sensor rows are averaged like binned pixels; scene columns are summed, so one binned scene pixel stands for
+    # a factor x factor block of full resolution ones
+    rows = (phi.shape[0] // factor) * factor
+    cols = (phi.shape[1] // factor) * factor
+    blocks = phi[:rows, :cols].reshape(rows // factor, factor, cols // factor, factor)
+    return blocks.mean(axis=1).sum(axis=2)
+
+
+def camera_key(fname: str):
+    # Same naming as PylonCam.open_cam: Cam_<SN>__<W>x<H>-<fmt>.npy
+    base = os.path.splitext(os.path.basename(fname))[0]
+    match = re.match(r'Cam_(.+)__(\d+)x(\d+)-(.+)$', base)
+    if match is None:
+        return {'serial': base, 'width': None, 'height': None, 'pixelFormat': None}
+    return {'serial': match.group(1), 'width': int(match.group(2)), 'height': int(match.group(3)),
+            'pixelFormat': match.group(4)}
+
+
+def cache_path(fname: str):
+    key = camera_key(fname)
+    if key['width'] is None:
+        base = 'Calib_' + key['serial']
+    else:
+        base = 'Calib_' + key['serial'] + '__' + str(key['width']) + 'x' + str(key['height']) + '-' + \
+               key['pixelFormat']
+    return os.path.join(os.path.dirname(os.path.abspath(fname)), base)
+
+
+def source_stamp(calib_path: str):
+    st = os.stat(calib_path)
+    return {'path': os.path.abspath(calib_path), 'size': st.st_size, 'mtime': st.st_mtime}
+
+
+def read_meta(path: str):
+    try:
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def cache_valid(meta, key: dict, shape, calib_path=None):
+    if meta is None:
+        return False
+    if meta.get('version') != CACHE_VERSION:
+        logging.info('Calibration cache version ' + str(meta.get('version')) + ' is stale')
+        return False
+    if meta.get('key') != key:
+        logging.info('Calibration cache belongs to ' + str(meta.get('key')))
+        return False
+    if tuple(meta.get('sensorShape', ())) != tuple(shape):
+        logging.info('Calibration cache is for sensor ' + str(meta.get('sensorShape')))
+        return False
+    if calib_path is not None and meta.get('source') != source_stamp(calib_path):
+        logging.info('Calibration source changed since cache was built')
+        return False
+    return True
+
+
+def build_cache(path: str, key: dict, shape, calib_path: str, lmbd):
+    phi_l, phi_r = load_calibration(calib_path)
+    factor = binning_factor((phi_l.shape[0], phi_r.shape[0]), shape)
+    if factor == 0:
+        raise ValueError('Calibration ' + calib_path + ' is for sensor ' + str((phi_l.shape[0], phi_r.shape[0])) +
+                         ' but sensor is ' + str(tuple(shape)))
+    if factor > 1:
+        phi_l = bin_calibration(phi_l, factor)
+        phi_r = bin_calibration(phi_r, factor)
+        logging.info('Calibration binned ' + str(factor) + 'x for sensor ' + str(tuple(shape)))
+    factors = decompose(phi_l, phi_r)
+    meta = {'version': CACHE_VERSION, 'key': key, 'sensorShape': list(shape),
+            'sceneShape': [phi_l.shape[1], phi_r.shape[1]], 'source': source_stamp(calib_path), 'lmbd': lmbd,
+            'binning': factor}
+
+    # Write next to the final location and swap in, so readers never see a half written cache
+    tmp = path + '.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    np.save(os.path.join(tmp, 'PhiL.npy'), phi_l)
+    np.save(os.path.join(tmp, 'PhiR.npy'), phi_r)
+    for name in FACTOR_NAMES:
+        np.save(os.path.join(tmp, name + '.npy'), factors[name])
+    np.save(os.path.join(tmp, 'F.npy'), tikhonov_filter(factors['SL'], factors['SR'], lmbd))
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp, path)
+    logging.info('Calibration cache written: ' + path)
+
+
+def load_cache(path: str):
+    meta = read_meta(path)
+    factors = dict()
+    for name in FACTOR_NAMES + ('F', 'PhiL', 'PhiR'):
+        factors[name] = np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+    factors['lmbd'] = meta['lmbd']
+    return factors
+
+
+def full_cache(fname: str, shape):
+    # An unbinned cache of the same camera whose sensor bins down to shape, to derive a preview calibration from
+    key = camera_key(fname)
+    pattern = os.path.join(os.path.dirname(cache_path(fname)), 'Calib_' + glob.escape(key['serial']) + '__*')
+    for path in sorted(glob.glob(pattern)):
+        meta = read_meta(path)
+        if path.endswith('.tmp') or meta is None or meta.get('version') != CACHE_VERSION:
+            continue
+        if meta.get('binning', 1) == 1 and binning_factor(meta['sensorShape'], shape) > 1:
+            return path
+    return None
+
+
+def open_calibration(fname: str, shape, calib_path=None, lmbd=1e-2):
+    path = cache_path(fname)
+    key = camera_key(fname)
+    if not cache_valid(read_meta(path), key, shape, calib_path):
+        if calib_path is None:
+            calib_path = full_cache(fname, shape)
+        if calib_path is None:
+            return None
+        build_cache(path, key, shape, calib_path, lmbd)
+    return load_cache(path)
@@ -1,48 +1,58 @@
 import logging
 import os
+import json
 import signal
 import sys
-from pypylon import pylon as py
-from pypylon import genicam
-import numpy as np
 # from multiprocessing import Process, Event
-import socket
-from select import select
-from threading import Thread, Event
-from queue import Queue, Full
+from threading import Thread
 from time import time
+from FC4D_DeviceCache import DeviceCache
+from FC4D_SharedFrames import FrameRing
+from FC4D_Packing import Unpacker, copy_result
+from FC4D_Preprocess import FramePreprocessor, Binner, DEFAULT_CAPTURE, stored_path
+from FC4D_Protocol import FrameNote, active_file_message, parse_notify_options
+from FC4D_Recorder import Recorder, recording_path
+from FC4D_Server import FrameServer, ImageSource
+from FC4D_Stats import RollingStat, clock, BUCKETS
+import FC4D_SimCamera
 
-global stoppingGuard, running, pyCam
+global stoppingGuard, running, pyCams, server, recordDir, recordBuffers
+
+DEFAULT_PREVIEW_BINNING = 2
+MAX_BINNING = 8
+
+# pypylon (or FC4D_SimCamera) is only imported in __main__, once we know which one is wanted
+py = None
+genicam = None
 
 
 class StopGuard:
     stop = False
 
-    def __init__(self):
+    def __init__(self, wake=None):
+        self.wake = wake
         signal.signal(signal.SIGINT, self.int_rcvd)
         signal.signal(signal.SIGTERM, self.term_rcvd)
 
     def int_rcvd(self, signum, frame):
         logging.warning('Interrupt signal received')
         self.stop = True
+        if self.wake is not None:
+            self.wake()
 
     def term_rcvd(self, signum, frame):
         logging.warning('Terminate signal received')
         self.stop = True
+        if self.wake is not None:
+            self.wake()
 
 
-class PylonCam:
-
-    def __init__(self):
-        self.allPixelFormatNames = dict()
-        self.allPixelFormatVals = dict()
+class PylonCam(ImageSource):
 
-        for attr in dir(py):
-            if 'PixelType_' in attr:
-                val = getattr(py, attr)
-                self.allPixelFormatNames.update({attr: val})
-                self.allPixelFormatVals.update({val: attr})
-        self.pixelFormats = dict()
+    def __init__(self, info=None, index=0, cache=None):
+        ImageSource.__init__(self)
+        self.cache = cache
+        self.caps = None
 
         self.cam = None
         self.IFC = None
@@ -50,68 +60,177 @@ class PylonCam:
 
         self.dType = None
         self.bytespp = None
-        self.info = None
-        self.SN = None
+        self.info = info
+        self.index = index
+        self.SN = info.GetSerialNumber() if info is not None else None
         self.W = None
         self.H = None
         self.f = None
         self.F = None
+        self.firmware = None
         self.fname = None
-        self.mm = None
+        self.slots = 8
+        self.packed = False
+        self.unpacker = None
+        self.binning = 1
+        self.binner = None
+        self.grabShape = None
+        self.ring = None
         self.grabbing = False
         self.grabber = None
         self.FPS = 0
-        self.imageClients = []
+        self.dropped = 0
+        self.server = None
+        self.recorder = None
+        self.preprocess = None
+        self.average = (None, 0)
+        self.useDark = False
+        self.useFlat = False
+        self.stats = {'retrieve': RollingStat(), 'copy': RollingStat(), 'preprocess': RollingStat()}
 
     def open_cam(self):
-        self.cam = py.InstantCamera(py.TlFactory.GetInstance().CreateFirstDevice())
+        if self.info is not None:
+            self.cam = py.InstantCamera(py.TlFactory.GetInstance().CreateDevice(self.info))
+        else:
+            self.cam = py.InstantCamera(py.TlFactory.GetInstance().CreateFirstDevice())
+            self.info = self.cam.GetDeviceInfo()
+        self.SN = self.info.GetSerialNumber()
         self.IFC = py.ImageFormatConverter()
 
-        for key, val in self.allPixelFormatNames.items():
-            try:
-                self.IFC.SetOutputPixelFormat(val)
-                self.pixelFormats.update({key: val})
-            except genicam.RuntimeException:
-                pass
-        if 'PixelType_Mono16' in self.pixelFormats.keys():
-            self.IFC.SetOutputPixelFormat(self.pixelFormats['PixelType_Mono16'])
+        self.caps = self.cache.get(self.SN, self.info) if self.cache is not None else None
+        if self.caps is None:
+            start = time()
+            self.caps = self.probe()
+            logging.info('Probed ' + self.SN + ' in ' + str(time() - start) + ' s')
+            if self.cache is not None:
+                self.caps = self.cache.put(self.SN, self.info, self.caps)
+
+        output_formats = self.caps['outputFormats']
+        if 'PixelType_Mono16' in output_formats:
+            self.IFC.SetOutputPixelFormat(py.PixelType_Mono16)
             self.dType = 'uint16'
             self.bytespp = 2
-        elif 'PixelType_Mono12' in self.pixelFormats.keys():
-            self.IFC.SetOutputPixelFormat(self.pixelFormats['PixelType_Mono12p'])
+        elif 'PixelType_Mono12' in output_formats:
+            self.IFC.SetOutputPixelFormat(py.PixelType_Mono12)
             self.dType = 'uint16'
             self.bytespp = 2
-        elif 'PixelType_Mono8' in self.pixelFormats.keys():
-            self.IFC.SetOutputPixelFormat(self.pixelFormats['PixelType_Mono8'])
+        elif 'PixelType_Mono8' in output_formats:
+            self.IFC.SetOutputPixelFormat(py.PixelType_Mono8)
             self.dType = 'uint8'
             self.bytespp = 1
 
-        self.info = self.cam.GetDeviceInfo()
-        self.SN = self.info.GetSerialNumber()
-
-        self.cam.Open()
-        self.W = self.cam.Width()
-        self.H = self.cam.Height()
-        self.f = self.cam.PixelFormat.GetValue()
-        self.cam.Close()
+        self.W = self.caps['width'] // self.binning
+        self.H = self.caps['height'] // self.binning
+        self.f = self.caps['pixelFormat']
+        self.firmware = self.caps['firmware']
+        # Frames come off the camera binned if it can bin, otherwise whole and they are binned into the ring
+        soft_bin = self.binning > 1 and not self.caps['binning']
+        self.grabShape = (self.caps['height'], self.caps['width']) if soft_bin else (self.H, self.W)
+        self.unpacker = None
+        if self.packed:
+            self.set_packed_format()
+        self.binner = Binner(self.grabShape, self.binning, self.dType) if soft_bin else None
 
         path_str = './Cam_' + self.SN + '__' + str(self.W) + 'x' + str(self.H) + '-' + self.f + '.npy'
         self.fname = os.path.abspath(path_str)
         print(self.fname)
 
         self.open_mm()
+        self.opened = True
+        # Subscribers that joined before the camera was opened have not seen its ring yet
+        if self.server is not None:
+            self.server.announce(self, self.active_file_message())
+
+    def probe(self):
+        # The slow part of opening a camera: every PixelType_* is tried on the converter and the camera is opened
+        # to read its geometry
+        output_formats = []
+        for attr in dir(py):
+            if 'PixelType_' in attr:
+                try:
+                    self.IFC.SetOutputPixelFormat(getattr(py, attr))
+                    output_formats.append(attr)
+                except genicam.RuntimeException:
+                    pass
+        self.cam.Open()
+        # Unbinned first, as the maximum size depends on the binning
+        binning = set_camera_binning(self.cam, 1)
+        width, height = full_frame(self.cam)
+        caps = {'outputFormats': output_formats, 'width': width, 'height': height,
+                'pixelFormat': self.cam.PixelFormat.GetValue(), 'pixelFormats': list(self.cam.PixelFormat.Symbolics),
+                'firmware': firmware_version(self.cam), 'binning': binning}
+        self.cam.Close()
+        return caps
+
+    def prepare_grab(self):
+        # The camera has to be opened to grab anyway, so this is where the cached geometry gets checked
+        self.cam.Open()
+        if self.cam.PixelFormat.GetValue() != self.f:
+            # Packed transfer, or a format left behind by an earlier run
+            self.cam.PixelFormat.SetValue(self.f)
+        if self.caps['binning'] and not set_camera_binning(self.cam, self.binning):
+            logging.error('Camera ' + self.SN + ' could not be binned ' + str(self.binning) + 'x')
+            return False
+        actual = (self.cam.Width(), self.cam.Height(), self.cam.PixelFormat.GetValue(), firmware_version(self.cam))
+        expected = (self.grabShape[1], self.grabShape[0], self.f, self.firmware)
+        if actual != expected:
+            logging.error('Camera ' + self.SN + ' is ' + str(actual) + ' but was cached as ' + str(expected) +
+                          ', release and stream it again')
+            if self.cache is not None:
+                self.cache.forget(self.SN)
+            return False
+        return True
+
+    def set_packed_format(self):
+        # Move Mono12p/Mono10p over the link and unpack into the ring; stays unpacked if the camera can't
+        available = self.caps['pixelFormats']
+        for fmt in ('Mono12p', 'Mono10p'):
+            if fmt in available:
+                try:
+                    unpacker = Unpacker(fmt, self.grabShape)
+                except ValueError as e:
+                    logging.warning(e)
+                    continue
+                self.f = fmt
+                self.unpacker = unpacker
+                self.dType = 'uint16'
+                self.bytespp = 2
+                logging.info('Packed transfer: ' + fmt + ', ' + str(unpacker.size) + ' bytes per frame')
+                return
+        logging.warning('No packed pixel format available, transferring unpacked')
 
     def open_mm(self):
-        if self.mm is not None:
-            del self.mm
-        if not os.path.exists(self.fname):
-            with open(self.fname, 'w+b') as f:
-                f.write(b'\n' * (round(self.W * self.H * self.bytespp)))
-        f = open(self.fname, 'r+b')
-        self.mm = np.memmap(f, dtype=self.dType, mode='w+', shape=(self.H, self.W))
+        if self.ring is not None:
+            self.ring.close()
+        self.ring = FrameRing.create(self.fname, self.H, self.W, self.dType, self.slots)
+        # Averaging and dark/flat settings carry over when the camera is opened again
+        self.preprocess = FramePreprocessor(self.fname, (self.H, self.W), self.dType)
+        if self.average[0] is not None:
+            self.preprocess.request(self.preprocess.set_average, *self.average)
+        if self.useDark:
+            self.preprocess.request(self.preprocess.load, 'dark')
+        if self.useFlat:
+            self.preprocess.request(self.preprocess.load, 'flat')
+
+    def active_file_message(self):
+        return active_file_message(self.fname, self.H, self.W, self.dType, self.slots, self.index)
+
+    def start_recording(self, directory: str, limit=0, buffers=64):
+        self.stop_recording()
+        self.recorder = Recorder(recording_path(directory, self.fname), self.fname, (self.H, self.W), self.dType,
+                                 limit, buffers, info={'serial': self.SN, 'pixelFormat': self.f,
+                                                       'firmware': self.firmware, 'raw': True,
+                                                       'cleaning': self.preprocess.describe()})
+        return self.recorder.path
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.close()
 
     def release_cam(self):
         self.grabbing = False
+        self.opened = False
+        self.stop_recording()
         if self.cam is not None:
             try:
                 self.cam.StopGrabbing()
@@ -119,33 +238,90 @@ class PylonCam:
                 try:
                     self.cam.Close()
                 finally:
-                    del self.mm
-                    self.mm = None
+                    if self.ring is not None:
+                        self.ring.close()
+                        self.ring = None
                     logging.info('Camera Released')
 
-    def add_image_client(self, image_client):
-        if not image_client in self.imageClients:
-            self.imageClients.append(image_client)
 
-    def rem_image_client(self, image_client):
-        if image_client in self.imageClients:
-            self.imageClients.remove(image_client)
+def firmware_version(cam):
+    try:
+        return str(cam.DeviceFirmwareVersion.GetValue())
+    except (AttributeError, genicam.GenericException):
+        return None
+
+
+def set_camera_binning(cam, factor: int):
+    # Averaging where the camera lets us choose, so binned pixels keep the pixel format's range; False if the
+    # camera has no binning
+    for node in ('BinningHorizontalMode', 'BinningVerticalMode'):
+        try:
+            getattr(cam, node).SetValue('Average')
+        except (AttributeError, genicam.GenericException):
+            pass
+    try:
+        cam.BinningHorizontal.SetValue(factor)
+        cam.BinningVertical.SetValue(factor)
+    except (AttributeError, genicam.GenericException):
+        return False
+    # Binning up shrinks Width/Height to fit, but binning down leaves them small
+    full_frame(cam)
+    return True
+
+
+def full_frame(cam):
+    # Width/Height up to WidthMax/HeightMax, the whole sensor at the current binning; returns the size
+    try:
+        cam.Width.SetValue(cam.WidthMax())
+        cam.Height.SetValue(cam.HeightMax())
+    except (AttributeError, genicam.GenericException) as e:
+        logging.debug(e)
+    return cam.Width(), cam.Height()
 
 
 def grab_frames(pycam: PylonCam):
+    if not pycam.prepare_grab():
+        return
     pycam.grabbing = True
     last_time = 0
     diff_times = [0] * 10
     counter_time = 0
     pycam.cam.StartGrabbing(py.GrabStrategy_LatestImageOnly)
+    retrieve_stat = pycam.stats['retrieve']
+    copy_stat = pycam.stats['copy']
+    preprocess_stat = pycam.stats['preprocess']
+    unpacker = pycam.unpacker
+    binner = pycam.binner
+    preprocess = pycam.preprocess
     while pycam.grabbing:
+        start = clock()
         grab_result = pycam.cam.RetrieveResult(5000, py.TimeoutHandling_ThrowException)
+        retrieve_stat.add(clock() - start)
         if not pycam.grabbing:
             continue
         if grab_result.GrabSucceeded():
-            pycam.mm[:] = grab_result.Array[:]
+            start = clock()
+            seq, frame = pycam.ring.begin_write()
+            if binner is None:
+                copy_result(grab_result, frame, unpacker)
+            else:
+                binner.bin(copy_result(grab_result, binner.full, unpacker), frame)
+            copy_stat.add(clock() - start)
             this_time = grab_result.TimeStamp
+            pycam.dropped += grab_result.GetNumberOfSkippedImages()
             grab_result.Release()
+            host_time = time()
+            recorder = pycam.recorder
+            if recorder is not None and recorder.recording:
+                # Recordings hold the frames as they came off the camera, before any cleaning, so replaying one
+                # through the grabber cleans it once with whatever is set then; only a copy into a free buffer,
+                # the recorder's own thread does the writing
+                recorder.add(frame, seq, this_time, host_time, pycam.dropped)
+            if preprocess.requests or preprocess.capture is not None or preprocess.active():
+                start = clock()
+                preprocess.process(frame)
+                preprocess_stat.add(clock() - start)
+            pycam.ring.commit(seq, this_time, host_time)
             if last_time > 0:
                 diff_times[counter_time] = this_time - last_time
                 counter_time = (counter_time + 1) % 10
@@ -153,114 +329,277 @@ def grab_frames(pycam: PylonCam):
                     pycam.FPS = 10000000000 / sum(diff_times)
             last_time = this_time
 
-            for iClient in pycam.imageClients:
-                sent = iClient.sendall(('cap:' + str(time()) + '\n').encode('utf-8'))
-                if sent == 0:
-                    iClient.close()
-                    pycam.imageClients.remove(iClient)
+            if pycam.server is not None:
+                pycam.server.publish(pycam, FrameNote(seq, pycam.ring.slot_of(seq), this_time, pycam.dropped,
+                                                      pycam.index), host_time)
     pycam.cam.StopGrabbing()
 
 
-def manage_client(new_client, notification_event, message_queue):
-    global running
-    connected = True
-    peername = str(new_client.getpeername())
-    stream = ''
-    logging.info('Client Manager Started')
-    new_client.send('connected\n'.encode('utf-8'))
-    while connected and running:
-        r, w, e = select([new_client, ], [], [], 0.01)
-        for c in r:
-            try:
-                data = c.recv(1024)
-            except ConnectionResetError as e:
-                logging.debug(e)
-                connected = False
-                try:
-                    c.shutdown(socket.SHUT_RDWR)
-                except OSError as e:
-                    logging.debug(e)
-                finally:
-                    c.close()
-                    logging.info('Client Disconnected: ' + peername)
-                continue
-            if len(data) == 0:
-                connected = False
-                try:
-                    c.shutdown(socket.SHUT_RDWR)
-                except OSError as e:
-                    logging.debug(e)
-                finally:
-                    c.close()
-                    logging.info('Client Disconnected: ' + peername)
-            logging.debug('Data received: ' + data.decode('utf-8'))
-            stream += data.decode('utf-8')
-            while '\n' in stream and running:
-                message, stream = stream.split('\n', 1)
-                put_in_queue = False
-                while not put_in_queue and running:
-                    try:
-                        message_queue.put([message, c], timeout=0.01)
-                    except Full:
-                        logging.debug(__name__ + ': Message Queue Full')
-                    except Exception as e:
-                        logging.error(e)
-                    else:
-                        put_in_queue = True
-                notification_event.set()
-    logging.info('Client Manager Closing: ' + peername)
-
-
-def parse_message(message: str, client: socket.socket):
-    global running, stoppingGuard, pyCam
+def camera_stats(pycam: PylonCam):
+    global server
+    # Times in us; 'hist' counts samples per log2 bucket starting at 'buckets'
+    return {'serial': pycam.SN, 'pixelFormat': pycam.f, 'packed': pycam.unpacker is not None, 'fps': pycam.FPS,
+            'binning': pycam.binning, 'softBinning': pycam.binner is not None,
+            'dropped': pycam.dropped, 'grabbing': pycam.grabbing,
+            'frames': pycam.ring.writeSeq if pycam.ring is not None else 0,
+            'recorder': pycam.recorder.stats() if pycam.recorder is not None else None,
+            'retrieve': pycam.stats['retrieve'].summary(), 'copy': pycam.stats['copy'].summary(),
+            'preprocess': pycam.stats['preprocess'].summary(),
+            'cleaning': pycam.preprocess.describe() if pycam.preprocess is not None else None,
+            'pending': server.pendingStat.summary(1, False),
+            'clients': [server.client_stats(c) for c in pycam.imageClients],
+            'buckets': (BUCKETS / 1000).tolist()}
+
+
+def enumerate_cams(slots: int, packed: bool, cache=None, average=None, dark=False, flat=False, binning=1):
+    cams = dict()
+    for index, info in enumerate(py.TlFactory.GetInstance().EnumerateDevices()):
+        pycam = PylonCam(info, index, cache)
+        pycam.slots = slots
+        pycam.packed = packed
+        pycam.average = parse_average(average.split(':')) if average else (None, 0)
+        pycam.useDark = dark
+        pycam.useFlat = flat
+        pycam.binning = binning
+        cams[pycam.SN] = pycam
+        logging.info('Found camera ' + pycam.SN + ' (' + info.GetModelName() + ')')
+    return cams
+
+
+def select_cams(options):
+    # Cameras named by serial in a command's options, every camera for 'all' and the first one when none is
+    # named; returns them with the options that are not camera names
+    global pyCams
+    cams = []
+    rest = []
+    for option in options:
+        if option in pyCams:
+            cams.append(pyCams[option])
+        elif option == 'all':
+            cams.extend(pyCams.values())
+        else:
+            rest.append(option)
+    if len(cams) == 0 and len(pyCams) > 0:
+        cams.append(next(iter(pyCams.values())))
+    return cams, rest
+
+
+def parse_average(options):
+    if len(options) == 0 or options[0] == 'off':
+        return None, 0
+    if options[0] == 'box' and len(options) > 1 and options[1].isdigit():
+        return 'box', int(options[1])
+    if options[0] == 'ema' and len(options) > 1:
+        return 'ema', float(options[1])
+    raise ValueError('Average needs box:<frames>, ema:<alpha> or off')
+
+
+def parse_mode(options):
+    if len(options) == 0:
+        raise ValueError('Mode needs preview[:<binning>] or full')
+    if options[0] == 'full':
+        return 1
+    if options[0] == 'preview':
+        factor = int(options[1]) if len(options) > 1 and options[1].isdigit() else DEFAULT_PREVIEW_BINNING
+        if 2 <= factor <= MAX_BINNING:
+            return factor
+    raise ValueError('Mode needs preview[:<binning>] (2-' + str(MAX_BINNING) + ') or full')
+
+
+def set_binning(pycam: PylonCam, factor: int):
+    # The ring changes size, so the camera is opened again with a new one; subscribers get its ActiveFile and a
+    # camera that was streaming carries on
+    streaming = pycam.grabbing
+    stop_grabbing(pycam)
+    pycam.binning = factor
+    if pycam.opened:
+        pycam.release_cam()
+        pycam.open_cam()
+    if streaming:
+        start_grabbing(pycam)
+
+
+def rem_image_client(client):
+    global pyCams
+    for pycam in pyCams.values():
+        pycam.rem_image_client(client)
+
+
+def start_grabbing(pycam: PylonCam):
+    if not pycam.opened:
+        pycam.open_cam()
+    if pycam.grabber is None or not pycam.grabber.is_alive():
+        pycam.grabber = Thread(target=grab_frames, args=(pycam, ))
+        pycam.grabber.start()
+
+
+def stop_grabbing(pycam: PylonCam):
+    if pycam.grabbing:
+        pycam.grabbing = False
+        while pycam.grabber.is_alive():
+            pycam.grabber.join(0.01)
+        pycam.grabber = None
+
+
+def parse_message(message: str, client):
+    global running, stoppingGuard, pyCams, recordDir, recordBuffers
     peername = str(client.getpeername())
-    parts = message.split(':', 1)
+    # <command>[:<serial>|:all][:<options>...]
+    parts = message.split(':')
     cmd = parts[0]
-    if len(parts) > 1:
-        argument = parts[1]
-    else:
-        argument = None
+    cams, options = select_cams(parts[1:])
     if 'close' in cmd:
         running = False
         logging.info('Stop Command: ' + peername)
         client.send(b'Stop Command Received\n')
-    elif 'release' in cmd:
+        return
+    if len(cams) == 0:
+        client.send(b'No camera\n')
+        return
+    if 'framedonotify' in cmd:
+        # framedonotify[:<serial>|:all][:binary][:latest|:<queue depth>]
+        try:
+            binary, depth = parse_notify_options(options)
+        except ValueError as e:
+            client.send((str(e) + '\n').encode('utf-8'))
+            return
+        for pycam in cams:
+            pycam.add_image_client(client, binary, depth)
+            logging.info('Frame Client Added :' + peername + ' to ' + pycam.SN + (' (binary)' if binary else ''))
+            if pycam.fname is not None:
+                client.send(pycam.active_file_message())
+        return
+    if 'dark' in cmd or 'flat' in cmd:
+        # dark|flat[:<serial>|:all]:capture[:<frames>], :on to apply the stored frame, :off
+        kind = 'dark' if 'dark' in cmd else 'flat'
+        action = options[0] if options else 'on'
+        applied = False
+        for pycam in cams:
+            if not pycam.opened:
+                pycam.open_cam()
+            if action == 'capture':
+                frames = int(options[1]) if len(options) > 1 and options[1].isdigit() else DEFAULT_CAPTURE
+                pycam.preprocess.request(pycam.preprocess.start_capture, kind, frames)
+                state = True
+            elif action == 'on':
+                # The load itself runs on the grab thread, so a missing frame is caught here where it can be answered
+                path = stored_path(pycam.fname, kind)
+                if not os.path.isfile(path):
+                    client.send(('No stored ' + kind + ' frame for ' + pycam.SN + ': ' + path + '\n').encode('utf-8'))
+                    continue
+                pycam.preprocess.request(pycam.preprocess.load, kind)
+                state = True
+            elif action == 'off':
+                pycam.preprocess.request(pycam.preprocess.set_dark if kind == 'dark' else pycam.preprocess.set_flat)
+                state = False
+            else:
+                client.send(('Unknown ' + kind + ' option: ' + action + '\n').encode('utf-8'))
+                return
+            if kind == 'dark':
+                pycam.useDark = state
+            else:
+                pycam.useFlat = state
+            applied = True
+        if applied:
+            client.send((kind.capitalize() + ' Command Received\n').encode('utf-8'))
+        return
+    if 'average' in cmd:
+        # average[:<serial>|:all]:box:<frames>, :ema:<alpha> or :off
+        try:
+            average = parse_average(options)
+        except ValueError as e:
+            client.send((str(e) + '\n').encode('utf-8'))
+            return
+        for pycam in cams:
+            pycam.average = average
+            if pycam.preprocess is not None:
+                pycam.preprocess.request(pycam.preprocess.set_average, *average)
+        client.send(b'Average Command Received\n')
+        return
+    if 'mode' in cmd:
+        # mode[:<serial>|:all]:preview[:<binning>] bins frames, in the camera if it can, mode[...]:full undoes it
+        try:
+            factor = parse_mode(options)
+        except ValueError as e:
+            client.send((str(e) + '\n').encode('utf-8'))
+            return
+        for pycam in cams:
+            if factor != pycam.binning:
+                set_binning(pycam, factor)
+            logging.info('Mode Command: ' + peername + ' ' + pycam.SN + ' binning ' + str(factor))
+            client.send(('Mode:' + pycam.SN + ':' + ('full' if factor == 1 else 'preview:' + str(factor)) +
+                         '\n').encode('utf-8'))
+        return
+    if 'record' in cmd:
+        # record[:<serial>|:all][:<frames>] starts (and streams), record[:<serial>|:all]:stop ends a recording
+        if 'stop' in options:
+            for pycam in cams:
+                if pycam.recorder is not None:
+                    pycam.stop_recording()
+                    client.send(('Recorded:' + pycam.recorder.path + ':' + str(pycam.recorder.written) + ':' +
+                                 str(pycam.recorder.skipped) + '\n').encode('utf-8'))
+            return
+        limit = 0
+        for option in options:
+            if option.isdigit():
+                limit = int(option)
+            else:
+                client.send(('Unknown camera: ' + option + '\n').encode('utf-8'))
+                return
+        for pycam in cams:
+            if not pycam.opened:
+                pycam.open_cam()
+            try:
+                path = pycam.start_recording(recordDir, limit, recordBuffers)
+            except OSError as e:
+                logging.error(e)
+                client.send(('Record failed: ' + str(e) + '\n').encode('utf-8'))
+                return
+            start_grabbing(pycam)
+            logging.info('Record Command: ' + peername + ' ' + pycam.SN + ' to ' + path)
+            client.send(('Recording:' + path + '\n').encode('utf-8'))
+        return
+    if len(options) > 0:
+        client.send(('Unknown camera: ' + options[0] + '\n').encode('utf-8'))
+        return
+    if 'release' in cmd:
         logging.info('Release Command: ' + peername)
-        pyCam.release_cam()
+        for pycam in cams:
+            pycam.release_cam()
         client.send(b'Release Command Received\n')
     elif 'open' in cmd:
         logging.info('Open Command: ' + peername)
-        pyCam.open_cam()
+        for pycam in cams:
+            pycam.open_cam()
         client.send(b'Open Command Received\n')
     elif 'activefile' in cmd:
         logging.info('Filename Request: ' + peername)
-        if pyCam.fname is not None:
-            client.send(('ActiveFile(s):' + pyCam.fname + ':' + str(pyCam.H) + ':' + str(pyCam.W) +
-                         ':' + pyCam.dType + '\n').encode('utf-8'))
-        else:
-            client.send(b'No active file')
-    elif 'framedonotify' in cmd:
-        pyCam.add_image_client(client)
-        logging.info('Frame Client Added :' + peername)
-        if pyCam.fname is not None:
-            client.send(('ActiveFile(s):' + pyCam.fname + ':' + str(pyCam.H) + ':' + str(pyCam.W) +
-                         ':' + pyCam.dType + '\n').encode('utf-8'))
-    elif 'farmenonotify' in cmd:
-        pyCam.rem_image_client(client)
+        for pycam in cams:
+            if pycam.fname is not None:
+                client.send(pycam.active_file_message())
+            else:
+                client.send(('No active file: ' + pycam.SN + '\n').encode('utf-8'))
+    elif 'framenonotify' in cmd or 'farmenonotify' in cmd:
+        # Without a serial the client leaves every camera
+        for pycam in cams if len(parts) > 1 else pyCams.values():
+            pycam.rem_image_client(client)
         logging.info('Frame Client Removed : ' + peername)
         client.send(b'Unsubscribed\n')
+    elif 'stats' in cmd:
+        for pycam in cams:
+            client.send(('Stats:' + json.dumps(camera_stats(pycam)) + '\n').encode('utf-8'))
+    elif 'dropped' in cmd:
+        for pycam in cams:
+            client.send(('Dropped:' + str(client.dropped) + ':' + str(pycam.dropped) + ':' + pycam.SN +
+                         '\n').encode('utf-8'))
     elif 'stream' in cmd:
-        if not pyCam.opened:
-            pyCam.open_cam()
-        if pyCam.grabber is None:
-            pyCam.grabber = Thread(target=grab_frames, args=(pyCam, ))
-            pyCam.grabber.start()
+        for pycam in cams:
+            start_grabbing(pycam)
     elif 'stop' in cmd:
-        if pyCam.grabbing:
-            pyCam.grabbing = False
-            while pyCam.grabber.is_alive():
-                pyCam.grabber.join(0.01)
-            pyCam.grabber = None
+        for pycam in cams:
+            stop_grabbing(pycam)
+    elif 'cameras' in cmd:
+        client.send(('Cameras:' + ':'.join(pyCams.keys()) + '\n').encode('utf-8'))
 
 
 if __name__ == '__main__':
@@ -269,6 +608,22 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-l', '--log_level', help='Specify log verbosity')
+    parser.add_argument('-s', '--slots', type=int, default=8, help='Number of frame slots in the shared ring')
+    parser.add_argument('-p', '--packed', action='store_true',
+                        help='Transfer Mono12p/Mono10p and unpack into the shared ring')
+    parser.add_argument('--device_cache', default='FC4D_Devices.json',
+                        help='Where probed camera capabilities and geometry are cached')
+    parser.add_argument('--record_dir', default='.', help='Where the record command writes recordings')
+    parser.add_argument('--record_buffers', type=int, default=64,
+                        help='Frames a recording may buffer before it skips frames instead of stalling grabs')
+    parser.add_argument('--average', help='Average frames in the grabber, box:<frames> or ema:<alpha>')
+    parser.add_argument('--dark', action='store_true', help='Subtract the stored dark frame')
+    parser.add_argument('--flat', action='store_true', help='Apply the stored flat field')
+    parser.add_argument('-b', '--binning', type=int, default=1,
+                        help='Start in preview mode with this binning, in the camera if it can bin')
+    parser.add_argument('-q', '--queue_depth', type=int, default=4,
+                        help='Frame notifications kept per subscriber before the oldest are dropped')
+    FC4D_SimCamera.add_arguments(parser)
 
     args = parser.parse_args()
     if args.log_level:
@@ -287,41 +642,44 @@ if __name__ == '__main__':
 
     logging.debug('Starting up CameraGrabber')
 
-    stoppingGuard = StopGuard()
-
-    pyCam = PylonCam()
-
-    serveSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    serveSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    serveSock.bind(('127.0.0.1', 0xFC4D))
-    serveSock.listen(128)
-
+    if args.simulate:
+        FC4D_SimCamera.configure_from_args(args)
+        py = FC4D_SimCamera
+        genicam = FC4D_SimCamera
+    else:
+        try:
+            from pypylon import pylon as py
+            from pypylon import genicam
+        except ImportError:
+            logging.critical('pypylon is not installed, use --simulate')
+            sys.exit(1)
+
+    pyCams = enumerate_cams(args.slots, args.packed, DeviceCache(args.device_cache), args.average, args.dark,
+                            args.flat, max(1, min(args.binning, MAX_BINNING)))
+    if len(pyCams) == 0:
+        logging.warning('No camera found')
+
+    recordDir = args.record_dir
+    recordBuffers = args.record_buffers
     running = True
-    clients = []
-    notification_event = Event()
-    message_queue = Queue()
-
-    while running and not stoppingGuard.stop:
-        r, w, e = select([serveSock, ], [], [], 0)
-        for request in r:
-            client, addr = serveSock.accept()
-            logging.info('Client connected @' + str(addr))
-            new_client = Thread(target=manage_client, args=(client, notification_event, message_queue))
-            new_client.start()
-            clients.append(new_client)
-        if notification_event.wait(0.01):
-            while not message_queue.empty() and running and not stoppingGuard.stop:
-                message, client = message_queue.get()
-                parse_message(message, client)
-            notification_event.clear()
-
-    logging.warning('Shutting Down')
-    running = False
-    pyCam.release_cam()
-    serveSock.close()
-    for c in clients:
-        while c.is_alive():
-            c.join(0.01)
+    server = FrameServer(('127.0.0.1', 0xFC4D), parse_message, rem_image_client, args.queue_depth)
+    for pyCam in pyCams.values():
+        pyCam.server = server
+    stoppingGuard = StopGuard(server.wake)
+
+    try:
+        server.serve(lambda: not running or stoppingGuard.stop)
+    finally:
+        # Grab threads are not daemons, so they have to be stopped whatever ended the loop
+        logging.warning('Shutting Down')
+        running = False
+        for pyCam in pyCams.values():
+            pyCam.grabbing = False
+        for pyCam in pyCams.values():
+            if pyCam.grabber is not None:
+                pyCam.grabber.join(6)
+            pyCam.release_cam()
+        server.close()
     sys.exit()
 
 
@@ -0,0 +1,67 @@
+import json
+import logging
+import os
+from threading import Lock
+
+# What a camera can do (converter output formats, sensor pixel formats) and its geometry, probed once per serial
+# and kept in one JSON file. An entry is dropped when the device info no longer matches, or when the camera
+# reports different geometry or firmware once it is opened for grabbing.
+
+DEVICE_CACHE_VERSION = 2
+INFO_GETTERS = ('GetVendorName', 'GetModelName', 'GetDeviceVersion', 'GetFullName')
+
+
+def device_stamp(info):
+    stamp = dict()
+    for getter in INFO_GETTERS:
+        if hasattr(info, getter):
+            stamp[getter[3:]] = str(getattr(info, getter)())
+    return stamp
+
+
+class DeviceCache:
+
+    def __init__(self, path: str):
+        self.path = os.path.abspath(path)
+        self.lock = Lock()
+        self.devices = self.read()
+
+    def read(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return dict()
+        if data.get('version') != DEVICE_CACHE_VERSION:
+            logging.info('Device cache version ' + str(data.get('version')) + ' is stale')
+            return dict()
+        return data.get('devices', dict())
+
+    def write(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'version': DEVICE_CACHE_VERSION, 'devices': self.devices}, f, indent=1)
+        os.replace(tmp, self.path)
+
+    def get(self, serial: str, info):
+        with self.lock:
+            entry = self.devices.get(serial)
+        if entry is None:
+            return None
+        if entry.get('device') != device_stamp(info):
+            logging.info('Device info of ' + serial + ' changed since it was cached')
+            return None
+        return entry
+
+    def put(self, serial: str, info, caps: dict):
+        entry = dict(caps)
+        entry['device'] = device_stamp(info)
+        with self.lock:
+            self.devices[serial] = entry
+            self.write()
+        return entry
+
+    def forget(self, serial: str):
+        with self.lock:
+            if self.devices.pop(serial, None) is not None:
+                self.write()
@@ -0,0 +1,180 @@
+import numpy as np
+from FC4D_Calibration import camera_key
+
+
+def sensor_bits(fname: str, d_type: str):
+    if np.dtype(d_type).itemsize == 1:
+        return 8
+    fmt = camera_key(fname)['pixelFormat'] or ''
+    for bits in (10, 12, 14, 16):
+        if str(bits) in fmt:
+            return bits
+    return 16
+
+
+class DisplayMapper:
+    # Raw 8-16 bit pixels go to 8 bit through one table lookup into a reused buffer. The table folds in black/white
+    # levels, contrast and gamma and is rebuilt (then swapped in whole) only when one of those changes. Frames come
+    # out at the target size, picked nearest neighbour through a precomputed index into reused buffers, so the
+    # display can paste them as they are; with bin on, the frame is binned by the whole factor it is larger first.
+    # Float frames (reconstructions) are first scaled into 16 bit over a range taken from the first frame.
+
+    def __init__(self, bits=12, in_type='uint16'):
+        self.bits = bits
+        self.inType = np.dtype(in_type)
+        self.black = 0
+        self.white = (1 << bits) - 1
+        self.contrast = 1.0
+        self.gamma = 1.0
+        self.auto = False
+        self.autoEvery = 15
+        self.bin = False
+        self.target = None
+        self.lut = None
+        self.factor = 1
+        self.shape = None
+        self.binned = False
+        self.out = None
+        self.acc = None
+        self.index = None
+        self.pick = None
+        self.lookupFirst = False
+        self.frames = 0
+        self.floatInput = False
+        self.floatRange = None
+        self.fBuf = None
+        self.qBuf = None
+        self.build_lut()
+
+    def set_bits(self, bits: int, in_type='uint16'):
+        self.floatInput = np.dtype(in_type).kind == 'f'
+        self.floatRange = None
+        if self.floatInput:
+            bits = 16
+            in_type = 'uint16'
+        if bits == self.bits and np.dtype(in_type) == self.inType:
+            return
+        self.bits = bits
+        self.inType = np.dtype(in_type)
+        self.black = 0
+        self.white = (1 << bits) - 1
+        self.build_lut()
+
+    def build_lut(self):
+        x = np.arange(1 << (8 * self.inType.itemsize), dtype='float32')
+        t = (x - self.black) / max(1, self.white - self.black)
+        t = 0.5 + self.contrast * (t - 0.5)
+        np.clip(t, 0, 1, out=t)
+        if self.gamma != 1.0:
+            np.power(t, 1 / self.gamma, out=t)
+        self.lut = (t * 255 + 0.5).astype('uint8')
+
+    def set_levels(self, black, white):
+        self.black = int(black)
+        self.white = int(max(white, black + 1))
+        self.build_lut()
+
+    def set_contrast(self, contrast: float):
+        self.contrast = max(0.05, contrast)
+        self.build_lut()
+
+    def set_gamma(self, gamma: float):
+        self.gamma = max(0.05, gamma)
+        self.build_lut()
+
+    def reset(self):
+        self.contrast = 1.0
+        self.gamma = 1.0
+        self.auto = False
+        self.floatRange = None
+        self.set_levels(0, (1 << self.bits) - 1)
+
+    def auto_level(self, frame, low=0.5, high=99.5):
+        step = max(1, min(frame.shape) // 128)
+        black, white = np.percentile(frame[::step, ::step], [low, high])
+        self.set_levels(black, white)
+
+    def set_target(self, size):
+        if size != self.target:
+            self.target = size
+            # Lay the buffers out again on the next frame
+            self.shape = None
+
+    def layout(self, shape):
+        self.shape = shape
+        self.binned = self.bin
+        h, w = shape
+        target = self.target
+        if target is not None and (target[0] <= 0 or target[1] <= 0):
+            target = None
+        factor = 1
+        if self.bin and target is not None:
+            factor = max(1, min(w // target[0], h // target[1]))
+        self.factor = factor
+        sh, sw = h // factor, w // factor
+        self.acc = np.empty((sh, sw), dtype='uint32') if factor > 1 else None
+        self.pick = None
+        self.lookupFirst = False
+        if target is None or target == (sw, sh):
+            self.index = None
+            self.out = np.empty((sh, sw), dtype='uint8')
+            return
+        tw, th = target
+        # Centre of each target pixel, as a flat index into the (binned) frame
+        rows = (2 * np.arange(th) + 1) * sh // (2 * th)
+        cols = (2 * np.arange(tw) + 1) * sw // (2 * tw)
+        self.index = (rows[:, None] * sw + cols[None, :]).astype(np.intp)
+        self.out = np.empty((th, tw), dtype='uint8')
+        if th * tw > sh * sw:
+            # Enlarging: look up the fewer source pixels and pick from the 8 bit result
+            self.lookupFirst = True
+            self.pick = np.empty((sh, sw), dtype='uint8')
+
+    def quantize(self, frame):
+        if self.qBuf is None or self.qBuf.shape != frame.shape:
+            self.fBuf = np.empty(frame.shape, dtype='float32')
+            self.qBuf = np.empty(frame.shape, dtype='uint16')
+        if self.floatRange is None:
+            step = max(1, min(frame.shape) // 128)
+            lo, hi = np.percentile(frame[::step, ::step], [0.1, 99.9])
+            self.floatRange = (float(lo), float(max(hi, lo + 1e-12)))
+        lo, hi = self.floatRange
+        np.subtract(frame, lo, out=self.fBuf)
+        np.multiply(self.fBuf, 65535 / (hi - lo), out=self.fBuf)
+        np.clip(self.fBuf, 0, 65535, out=self.fBuf)
+        np.copyto(self.qBuf, self.fBuf, casting='unsafe')
+        return self.qBuf
+
+    def map(self, frame):
+        if self.floatInput:
+            frame = self.quantize(frame)
+        if frame.shape != self.shape or self.bin != self.binned:
+            self.layout(frame.shape)
+        f = self.factor
+        self.frames += 1
+        if self.auto and self.frames % self.autoEvery == 1:
+            self.auto_level(frame)
+        lut = self.lut
+        if f == 1:
+            src = frame
+        else:
+            acc = self.acc
+            oh, ow = acc.shape
+            np.copyto(acc, frame[:oh * f:f, :ow * f:f])
+            for dy in range(f):
+                for dx in range(f):
+                    if dy or dx:
+                        np.add(acc, frame[dy:oh * f:f, dx:ow * f:f], out=acc)
+            np.floor_divide(acc, f * f, out=acc)
+            src = acc
+        if self.index is None:
+            np.take(lut, src, out=self.out, mode='clip')
+        elif self.lookupFirst:
+            np.take(lut, src, out=self.pick, mode='clip')
+            np.take(self.pick, self.index, out=self.out, mode='clip')
+        else:
+            if self.pick is None or self.pick.dtype != src.dtype:
+                self.pick = np.empty(self.out.shape, dtype=src.dtype)
+            np.take(src, self.index, out=self.pick, mode='clip')
+            np.take(lut, self.pick, out=self.out, mode='clip')
+        return self.out
@@ -0,0 +1,82 @@
+import numpy as np
+
+# GenICam PFNC LSB-first packed mono formats: Mono12p is 2 pixels in 3 bytes, Mono10p 4 pixels in 5 bytes
+
+PACKED_BITS = {'Mono10p': 10, 'Mono12p': 12}
+
+
+def packed_size(fmt: str, pixels: int):
+    return (pixels * PACKED_BITS[fmt] + 7) // 8
+
+
+def group_layout(bits: int):
+    # Every pixel of a group spans exactly two bytes: (low byte, its shift, high byte, high mask, high shift)
+    pixels = 8 // np.gcd(bits, 8)
+    layout = []
+    for k in range(pixels):
+        start = k * bits
+        lo = start // 8
+        shift = start % 8
+        layout.append((lo, shift, lo + 1, (1 << (bits - 8 + shift)) - 1, 8 - shift))
+    return pixels, pixels * bits // 8, layout
+
+
+class Unpacker:
+    # Unpacks a raw packed payload into a caller's uint16 frame (a ring slot) with whole-frame numpy ops per
+    # position in the pixel group and a single reused scratch column, so nothing is allocated per frame
+
+    def __init__(self, fmt: str, shape):
+        self.fmt = fmt
+        self.bits = PACKED_BITS[fmt]
+        self.shape = tuple(shape)
+        self.groupPixels, self.groupBytes, self.layout = group_layout(self.bits)
+        n = self.shape[0] * self.shape[1]
+        if n % self.groupPixels:
+            raise ValueError(fmt + ' needs a multiple of ' + str(self.groupPixels) + ' pixels, got ' + str(n))
+        self.groups = n // self.groupPixels
+        self.size = self.groups * self.groupBytes
+        self.tmp = np.empty(self.groups, dtype='uint16')
+
+    def unpack(self, raw, out):
+        raw = np.frombuffer(raw, dtype='uint8', count=self.size).reshape(self.groups, self.groupBytes)
+        dst = out.reshape(self.groups, self.groupPixels)
+        tmp = self.tmp
+        for k, (lo, shift, hi, mask, hshift) in enumerate(self.layout):
+            col = dst[:, k]
+            np.right_shift(raw[:, lo], shift, out=col, dtype='uint16')
+            np.bitwise_and(raw[:, hi], mask, out=tmp, dtype='uint16')
+            np.left_shift(tmp, hshift, out=tmp)
+            np.bitwise_or(col, tmp, out=col)
+        return out
+
+
+def pack(frame, fmt: str):
+    # Inverse of Unpacker.unpack, used by the simulated camera and to check the kernels
+    bits = PACKED_BITS[fmt]
+    pixels, nbytes, layout = group_layout(bits)
+    src = np.ascontiguousarray(frame, dtype='uint16').reshape(-1, pixels)
+    raw = np.zeros((len(src), nbytes), dtype='uint8')
+    for k, (lo, shift, hi, mask, hshift) in enumerate(layout):
+        raw[:, lo] |= ((src[:, k] << shift) & 0xFF).astype('uint8')
+        raw[:, hi] |= ((src[:, k] >> hshift) & mask).astype('uint8')
+    return raw.reshape(-1)
+
+
+def copy_result(grab_result, out, unpacker=None):
+    # The one copy of a frame: from the grab buffer straight into `out` (a ring slot). pypylon's GetArrayZeroCopy
+    # views the buffer itself, which is only valid inside the context, and raises on leaving it while the view is
+    # referenced from anywhere but the with target, so the copy happens right here and the name goes before the
+    # block ends; Array/GetBuffer copy the buffer on pypylon versions without it
+    raw = unpacker is not None
+    if hasattr(grab_result, 'GetArrayZeroCopy'):
+        with grab_result.GetArrayZeroCopy(raw=raw) as arr:
+            if raw:
+                unpacker.unpack(arr, out)
+            else:
+                np.copyto(out, arr)
+            del arr
+    elif raw:
+        unpacker.unpack(grab_result.GetBuffer(), out)
+    else:
+        np.copyto(out, grab_result.Array)
+    return out
@@ -0,0 +1,202 @@
+import logging
+import os
+import numpy as np
+from collections import deque
+from threading import Thread
+
+# Cleans frames in place in their ring slot before they are committed: an optional temporal average (a running
+# box sum of the last N frames in uint32, or an exponential moving average in float32), then dark subtraction and
+# flat field gain in float32, then back to the ring's integer type. Commands only queue changes; the grab thread
+# applies them between frames, so nothing here needs a lock.
+
+DEFAULT_CAPTURE = 32
+
+
+def stored_path(fname: str, kind: str):
+    # Dark_<SN>__<W>x<H>-<fmt>.npy next to the camera's Cam_<SN>__<W>x<H>-<fmt>.npy ring
+    base = os.path.basename(fname)
+    if base.startswith('Cam_'):
+        base = base[4:]
+    return os.path.join(os.path.dirname(os.path.abspath(fname)), kind.capitalize() + '_' + base)
+
+
+class FramePreprocessor:
+
+    def __init__(self, fname: str, shape, d_type: str):
+        self.fname = fname
+        self.shape = tuple(shape)
+        self.dType = d_type
+        self.maxVal = np.iinfo(d_type).max
+        self.requests = deque()
+        self.mode = None
+        self.alpha = 0.0
+        self.boxN = 0
+        self.history = None
+        self.acc = None
+        self.ema = None
+        self.count = 0
+        self.pos = 0
+        self.dark = None
+        self.flat = None
+        self.gain = None
+        self.capture = None
+        self.work = np.empty(self.shape, dtype='float32')
+
+    def request(self, fn, *args):
+        # Called from the server thread
+        self.requests.append((fn, args))
+
+    def active(self):
+        return self.mode is not None or self.dark is not None or self.gain is not None
+
+    def set_average(self, mode=None, value=0):
+        self.history = None
+        self.acc = None
+        self.ema = None
+        self.count = 0
+        self.pos = 0
+        self.mode = mode
+        if mode == 'box':
+            self.boxN = max(1, int(value))
+            self.history = np.zeros((self.boxN, ) + self.shape, dtype=self.dType)
+            self.acc = np.zeros(self.shape, dtype='uint32')
+        elif mode == 'ema':
+            self.alpha = min(1.0, max(1e-4, float(value)))
+            self.ema = np.zeros(self.shape, dtype='float32')
+        elif mode is not None:
+            raise ValueError('Unknown averaging mode ' + str(mode))
+        logging.info('Averaging: ' + str(mode) + ' ' + str(value))
+
+    def set_dark(self, dark=None):
+        self.dark = None if dark is None else np.asarray(dark, dtype='float32')
+        self.update_gain()
+
+    def set_flat(self, flat=None):
+        self.flat = None if flat is None else np.asarray(flat, dtype='float32')
+        self.update_gain()
+
+    def update_gain(self):
+        if self.flat is None:
+            self.gain = None
+            return
+        signal = self.flat - self.dark if self.dark is not None else self.flat.copy()
+        mean = float(signal.mean())
+        np.maximum(signal, max(mean, 1.0) * 1e-3, out=signal)
+        self.gain = (mean / signal).astype('float32')
+
+    def load(self, kind: str):
+        path = stored_path(self.fname, kind)
+        frame = np.load(path)
+        if frame.shape != self.shape:
+            raise ValueError(path + ' is ' + str(frame.shape) + ' but frames are ' + str(self.shape))
+        if kind == 'dark':
+            self.set_dark(frame)
+        else:
+            self.set_flat(frame)
+        logging.info('Loaded ' + path)
+
+    def start_capture(self, kind: str, frames=DEFAULT_CAPTURE):
+        # Averages the next raw frames into a new dark or flat frame, stores it and starts applying it
+        self.capture = [kind, max(1, frames), np.zeros(self.shape, dtype='float64'), 0]
+
+    def capture_frame(self, frame):
+        kind, frames, acc, count = self.capture
+        np.add(acc, frame, out=acc)
+        self.capture[3] = count + 1
+        if count + 1 < frames:
+            return
+        self.capture = None
+        mean = (acc / frames).astype('float32')
+        # It is applied from the next frame on; writing it out is left to a thread of its own so the grab loop
+        # never waits on the disk
+        Thread(target=self.store, args=(kind, mean, frames)).start()
+        if kind == 'dark':
+            self.set_dark(mean)
+        else:
+            self.set_flat(mean)
+
+    def store(self, kind: str, frame, frames: int):
+        # Through a temporary file, so a load of the same kind never sees half of it
+        path = stored_path(self.fname, kind)
+        tmp = path[:-len('.npy')] + '.tmp.npy'
+        try:
+            np.save(tmp, frame)
+            os.replace(tmp, path)
+        except OSError as e:
+            logging.error(e)
+            return
+        logging.info('Captured ' + kind + ' frame from ' + str(frames) + ' frames: ' + path)
+
+    def process(self, frame):
+        while self.requests:
+            fn, args = self.requests.popleft()
+            try:
+                fn(*args)
+            except (OSError, ValueError) as e:
+                logging.error(e)
+        if self.capture is not None:
+            self.capture_frame(frame)
+        if not self.active():
+            return frame
+        work = self.work
+        if self.mode == 'box':
+            acc = self.acc
+            oldest = self.history[self.pos]
+            if self.count == self.boxN:
+                np.subtract(acc, oldest, out=acc)
+            else:
+                self.count += 1
+            np.add(acc, frame, out=acc)
+            np.copyto(oldest, frame)
+            self.pos = (self.pos + 1) % self.boxN
+            np.multiply(acc, np.float32(1 / self.count), out=work, dtype='float32')
+        elif self.mode == 'ema':
+            ema = self.ema
+            if self.count == 0:
+                np.copyto(ema, frame)
+            else:
+                np.subtract(frame, ema, out=work, dtype='float32')
+                np.multiply(work, self.alpha, out=work)
+                np.add(ema, work, out=ema)
+            self.count += 1
+            np.copyto(work, ema)
+        else:
+            np.copyto(work, frame)
+        if self.dark is not None:
+            np.subtract(work, self.dark, out=work)
+        if self.gain is not None:
+            np.multiply(work, self.gain, out=work)
+        np.rint(work, out=work)
+        np.clip(work, 0, self.maxVal, out=work)
+        np.copyto(frame, work, casting='unsafe')
+        return frame
+
+    def describe(self):
+        return {'average': self.mode, 'alpha': self.alpha if self.mode == 'ema' else None,
+                'frames': self.boxN if self.mode == 'box' else None, 'dark': self.dark is not None,
+                'flat': self.gain is not None, 'capturing': self.capture[0] if self.capture is not None else None}
+
+
+class Binner:
+    # Software binning for cameras that can't bin: the grab is copied whole into `full`, then factor x factor
+    # blocks are summed into a reused uint32 buffer and averaged into the (smaller) ring slot
+
+    def __init__(self, shape, factor: int, d_type: str):
+        self.factor = factor
+        self.full = np.empty(shape, dtype=d_type)
+        self.shape = (shape[0] // factor, shape[1] // factor)
+        self.acc = np.empty(self.shape, dtype='uint32')
+
+    def bin(self, frame, out):
+        f = self.factor
+        h, w = self.shape
+        acc = self.acc
+        # One strided add per position in the block beats reducing a reshaped view by an order of magnitude
+        np.add(frame[:h * f:f, :w * f:f], f * f // 2, out=acc, dtype='uint32')
+        for dy in range(f):
+            for dx in range(f):
+                if dy or dx:
+                    np.add(acc, frame[dy:h * f:f, dx:w * f:f], out=acc)
+        np.floor_divide(acc, f * f, out=acc)
+        np.copyto(out, acc, casting='unsafe')
+        return out
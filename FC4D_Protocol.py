@@ -0,0 +1,88 @@
+import struct
+from collections import namedtuple
+
+# Text messages are '\n' terminated UTF-8 lines. Binary notification packets start with a 0x00 marker byte,
+# which never starts a text line, followed by the camera index, a record count and that many fixed size frame
+# records of that camera.
+PACKET_MARKER = 0
+packetHeader = struct.Struct('<BBH')
+frameRecord = struct.Struct('<QIQI')
+MAX_RECORDS = 0xFFFF
+
+FrameNote = namedtuple('FrameNote', ['seq', 'slot', 'timestamp', 'dropped', 'camera'], defaults=(0, ))
+
+
+def cap_message(host_time: float, seq: int):
+    return ('cap:' + str(host_time) + ':' + str(seq) + '\n').encode('utf-8')
+
+
+def active_file_message(fname: str, h: int, w: int, d_type: str, slots: int, camera=0):
+    return ('ActiveFile(s):' + fname + ':' + str(h) + ':' + str(w) + ':' + d_type + ':' + str(slots) + ':' +
+            str(camera) + '\n').encode('utf-8')
+
+
+def parse_active_file(message: str):
+    # ActiveFile(s):<path>:<H>:<W>:<dtype>:<slots>:<camera>, split from the right as the path may contain ':'
+    fname, h, w, d_type, slots, camera = message.split(':', 1)[1].rsplit(':', 5)
+    return fname, int(h), int(w), d_type, int(slots), int(camera)
+
+
+def parse_notify_options(options):
+    # framedonotify[:<serial>][:binary][:latest|:<queue depth>] with the serials already taken out; returns binary
+    # and the queue depth, None to keep the server's
+    binary = 'binary' in options
+    depth = None
+    for option in options:
+        if option == 'latest':
+            depth = 1
+        elif option.isdigit():
+            depth = int(option)
+        elif option != 'binary':
+            raise ValueError('Unknown camera: ' + option)
+    return binary, depth
+
+
+def pack_notifications(notes, camera=0):
+    packets = []
+    for start in range(0, len(notes), MAX_RECORDS):
+        chunk = notes[start:start + MAX_RECORDS]
+        packet = bytearray(packetHeader.size + frameRecord.size * len(chunk))
+        packetHeader.pack_into(packet, 0, PACKET_MARKER, camera, len(chunk))
+        offset = packetHeader.size
+        for note in chunk:
+            frameRecord.pack_into(packet, offset, note[0], note[1], note[2], note[3] & 0xFFFFFFFF)
+            offset += frameRecord.size
+        packets.append(bytes(packet))
+    return b''.join(packets)
+
+
+class NotificationParser:
+
+    def __init__(self):
+        self.buffer = b''
+
+    def feed(self, data: bytes):
+        # Returns text lines (str) and frame records (FrameNote) in the order they arrived
+        self.buffer += data
+        events = []
+        pos = 0
+        n = len(self.buffer)
+        while pos < n:
+            if self.buffer[pos] == PACKET_MARKER:
+                if n - pos < packetHeader.size:
+                    break
+                _marker, camera, count = packetHeader.unpack_from(self.buffer, pos)
+                end = pos + packetHeader.size + count * frameRecord.size
+                if end > n:
+                    break
+                for fields in frameRecord.iter_unpack(self.buffer[pos + packetHeader.size:end]):
+                    events.append(FrameNote(*fields, camera))
+                pos = end
+            else:
+                end = self.buffer.find(b'\n', pos)
+                if end < 0:
+                    break
+                events.append(self.buffer[pos:end].decode('utf-8'))
+                pos = end + 1
+        self.buffer = self.buffer[pos:]
+        return events
@@ -1,51 +1,669 @@
+import json
 import logging
+import os
 import socket
 from select import select
 import numpy as np
-from time import time
+import multiprocessing as mp
+from collections import deque
+from threading import Thread, Lock
+from time import time, perf_counter
+from FC4D_Calibration import open_calibration, cache_path, load_cache, camera_key
+from FC4D_Recorder import Recording
+from FC4D_Server import FrameServer, ImageSource
+from FC4D_SharedFrames import FrameRing
+from FC4D_Protocol import FrameNote, NotificationParser, parse_active_file, active_file_message, parse_notify_options
 
-global connected, MMFile
+global connected, MMFile, engine, frameStats, output
+
+OUTPUT_PORT = 0xFC4E
+# AdmmEngine tries its less favoured start every START_PROBE frames; START_WEIGHT weighs the newest iteration count
+# in its running means
+START_PROBE = 16
+START_WEIGHT = 0.25
+
+
+class TikhonovEngine:
+    # Separable model Y = PhiL X PhiR^T with PhiL = UL SL VL^T and PhiR = UR SR VR^T, so the regularized
+    # solution is X = VL [F * (UL^T Y UR)] VR^T with F = sL sR^T / ((sL sR^T)^2 + lambda).
+
+    def __init__(self, factors: dict, lmbd=1e-2, dtype='float32'):
+        self.dType = np.dtype(dtype)
+        self.uLt = np.ascontiguousarray(np.asarray(factors['UL']).T, dtype=self.dType)
+        self.uR = np.ascontiguousarray(factors['UR'], dtype=self.dType)
+        self.vL = np.ascontiguousarray(factors['VL'], dtype=self.dType)
+        self.vRt = np.ascontiguousarray(np.asarray(factors['VR']).T, dtype=self.dType)
+        self.sigma = np.outer(factors['SL'], factors['SR']).astype(self.dType)
+        self.filt = np.empty_like(self.sigma)
+        self.lmbd = None
+        if 'F' in factors and factors.get('lmbd') == lmbd:
+            self.lmbd = float(lmbd)
+            np.copyto(self.filt, factors['F'], casting='unsafe')
+        else:
+            self.set_lambda(lmbd)
+
+        kl, h = self.uLt.shape
+        w, kr = self.uR.shape
+        n = self.vL.shape[0]
+        m = self.vRt.shape[1]
+        self.sensorShape = (h, w)
+        self.sceneShape = (n, m)
+        # Multiply whichever side first gives the cheaper pair of products
+        self.leftFirst = kl * h * w + kl * w * kr <= h * w * kr + kl * h * kr
+
+        self.yBuf = np.empty((h, w), dtype=self.dType)
+        if self.leftFirst:
+            self.t1 = np.empty((kl, w), dtype=self.dType)
+        else:
+            self.t1 = np.empty((h, kr), dtype=self.dType)
+        self.t2 = np.empty((kl, kr), dtype=self.dType)
+        self.t3 = np.empty((n, kr), dtype=self.dType)
+        self.out = np.empty((n, m), dtype=self.dType)
+
+    def set_lambda(self, lmbd):
+        self.lmbd = float(lmbd)
+        np.square(self.sigma, out=self.filt)
+        self.filt += self.lmbd
+        np.divide(self.sigma, self.filt, out=self.filt)
+
+    def process(self, frame):
+        self.project(frame)
+        np.multiply(self.t2, self.filt, out=self.t2)
+        np.matmul(self.vL, self.t2, out=self.t3)
+        np.matmul(self.t3, self.vRt, out=self.out)
+        return self.out
+
+    def project(self, frame):
+        # UL^T Y UR, the frame in the singular bases; returns the engine's own buffer
+        np.copyto(self.yBuf, frame, casting='unsafe')
+        if self.leftFirst:
+            np.matmul(self.uLt, self.yBuf, out=self.t1)
+            np.matmul(self.t1, self.uR, out=self.t2)
+        else:
+            np.matmul(self.yBuf, self.uR, out=self.t1)
+            np.matmul(self.uLt, self.t1, out=self.t2)
+        return self.t2
+
+    def sweep(self, frame, lambdas, out=None):
+        # One projection of the frame, then every lambda's filter at once on the (k, kl, kr) stack and the back
+        # projections as two stacked GEMMs; scores come from the projected data alone
+        lambdas = np.asarray(lambdas, dtype='float64')
+        k = len(lambdas)
+        n, m = self.sceneShape
+        kl, kr = self.t2.shape
+        y_hat = self.project(frame)
+        y_norm = float(np.square(self.yBuf, dtype='float64').sum())
+        sigma2 = np.square(self.sigma)
+        z = np.add(sigma2, lambdas.astype(self.dType)[:, None, None])
+        np.divide(self.sigma, z, out=z)
+        np.multiply(z, y_hat, out=z)
+        if out is None:
+            out = np.empty((k, n, m), dtype=self.dType)
+        t3 = np.matmul(self.vL, z)
+        np.matmul(t3.reshape(k * n, kr), self.vRt, out=out.reshape(k * n, m))
+        return out, lambda_scores(y_hat, self.sigma, lambdas, y_norm, self.sensorShape)
+
+    def process_batch(self, frames, out=None):
+        # Offline stacks go through process() frame by frame into one preallocated output. Laying a block of
+        # frames side by side as one (h, k*w) matrix, so every product is a single GEMM, was tried and measured
+        # 0.6-1.1x of this loop from 160x120 to 1280x1024 with single threaded BLAS, which the per frame products
+        # already keep busy. It is worth another look only with numbers from a multi-threaded BLAS.
+        k = len(frames)
+        if out is None:
+            out = np.empty((k, ) + self.sceneShape, dtype=self.dType)
+        for i in range(k):
+            out[i] = self.process(frames[i])
+        return out
+
+
+class AdmmEngine(TikhonovEngine):
+    # Minimises 1/2 ||PhiL X PhiR^T - Y||^2 + tau R(Z) subject to X = Z, R the isotropic TV or the L1 norm, by
+    # scaled ADMM. The X update (PhiL^T PhiL (x) PhiR^T PhiR + rho) X = B + rho W, W = Z - U, is diagonal in the
+    # singular bases: X = W + VL [(S * Y^ - S^2 * W^) / (S^2 + rho)] VR^T with W^ = VL^T W VR, so each iteration
+    # is four separable products and a prox. Z carries over from frame to frame (the first frame starts from
+    # the Tikhonov solution), U is rebuilt for the new frame and the TV dual restarts, and iteration stops once
+    # X - Z and the change of Z fall below tol relative to Z.
+    # Whether the warm start pays depends on tau and on the noise: with a weak prior the Tikhonov solution is
+    # already close and the last frame's noise only gets in the way. So each frame starts from whichever start
+    # has needed fewer iterations on average lately, and the other one is tried every START_PROBE frames.
+    # rho is relative to the largest S^2, tau to the largest value of B = PhiL^T Y PhiR.
+
+    def __init__(self, factors: dict, lmbd=1e-2, tau=1e-4, prior='tv', max_iter=50, tol=1e-3, rho=1e-3,
+                 nonneg=True, tv_iter=20, dtype='float32'):
+        TikhonovEngine.__init__(self, factors, lmbd, dtype)
+        if prior not in ('tv', 'l1'):
+            raise ValueError('Unknown prior ' + str(prior))
+        self.vLt = np.ascontiguousarray(self.vL.T)
+        self.vR = np.ascontiguousarray(self.vRt.T)
+        sigma2 = np.square(self.sigma)
+        self.rho = rho * float(sigma2.max())
+        self.inv = (1 / (sigma2 + self.rho)).astype(self.dType)
+        self.sigma2 = sigma2
+        self.tau = tau
+        self.prior = prior
+        self.maxIter = max_iter
+        self.tol = tol
+        self.nonneg = nonneg
+        self.tvIter = tv_iter
+        self.warm = False
+        self.iterations = 0
+        # Running mean iterations from the warm and the cold start, and frames since the other one was tried
+        self.startCost = {True: None, False: None}
+        self.sinceProbe = 0
+
+        n, m = self.sceneShape
+        kl, kr = self.t2.shape
+        self.sy = np.empty((kl, kr), dtype=self.dType)
+        self.wHat = np.empty((kl, kr), dtype=self.dType)
+        self.t4 = np.empty((kl, m), dtype=self.dType)
+        self.x = np.empty((n, m), dtype=self.dType)
+        self.z = np.empty((n, m), dtype=self.dType)
+        self.u = np.zeros((n, m), dtype=self.dType)
+        self.w = np.empty((n, m), dtype=self.dType)
+        self.tikhonov = np.empty((n, m), dtype=self.dType)
+        self.tmp = np.empty((n, m), dtype=self.dType)
+        self.p = np.zeros((2, n, m), dtype=self.dType)
+        self.g = np.empty((2, n, m), dtype=self.dType)
+        self.div = np.empty((n, m), dtype=self.dType)
+        self.gNorm = np.empty((n, m), dtype=self.dType)
+
+    def reset(self):
+        self.warm = False
+        self.u[:] = 0
+        self.p[:] = 0
+
+    def start_warm(self):
+        if not self.warm:
+            return False
+        warm_cost, cold_cost = self.startCost[True], self.startCost[False]
+        if warm_cost is None or cold_cost is None:
+            return warm_cost is None
+        better = warm_cost <= cold_cost
+        self.sinceProbe += 1
+        if self.sinceProbe >= START_PROBE:
+            self.sinceProbe = 0
+            return not better
+        return better
+
+    def back_project(self, z, out):
+        np.matmul(self.vL, z, out=self.t3)
+        np.matmul(self.t3, self.vRt, out=out)
+        return out
+
+    def process(self, frame):
+        y_hat = self.project(frame)
+        x, z, u, w, tmp, w_hat = self.x, self.z, self.u, self.w, self.tmp, self.wHat
+        np.multiply(y_hat, self.filt, out=w_hat)
+        self.back_project(w_hat, w)
+        warm = self.start_warm()
+        if warm:
+            # Shift the last solution by the change of the closed form one, so directions the data barely
+            # constrains follow the new frame instead of keeping the old one
+            np.subtract(w, self.tikhonov, out=tmp)
+            np.add(z, tmp, out=z)
+        else:
+            np.copyto(z, w)
+        np.copyto(self.tikhonov, w)
+        np.multiply(y_hat, self.sigma, out=self.sy)
+        if warm:
+            # The dual of the last frame belongs to the last B; U = (B - G Z) / rho for the new B makes the first
+            # X update return Z itself, so the iteration starts where the warm Z is instead of undoing it
+            np.matmul(self.vLt, z, out=self.t4)
+            np.matmul(self.t4, self.vR, out=w_hat)
+            np.multiply(w_hat, self.sigma2, out=w_hat)
+            np.subtract(self.sy, w_hat, out=w_hat)
+            self.back_project(w_hat, u)
+            np.multiply(u, 1 / self.rho, out=u)
+        else:
+            u[:] = 0
+        self.p[:] = 0
+        self.warm = True
+        threshold = self.tau * float(np.abs(self.back_project(self.sy, tmp)).max()) / self.rho
+
+        for k in range(self.maxIter):
+            np.subtract(z, u, out=w)
+            np.matmul(self.vLt, w, out=self.t4)
+            np.matmul(self.t4, self.vR, out=w_hat)
+            np.multiply(w_hat, self.sigma2, out=w_hat)
+            np.subtract(self.sy, w_hat, out=w_hat)
+            np.multiply(w_hat, self.inv, out=w_hat)
+            self.back_project(w_hat, x)
+            np.add(x, w, out=x)
+
+            # Z update: prox of the prior at X + U; the old Z is kept in w for the residual
+            np.copyto(w, z)
+            np.add(x, u, out=tmp)
+            if self.prior == 'tv':
+                self.tv_prox(tmp, threshold, z)
+                if self.nonneg:
+                    np.maximum(z, 0, out=z)
+            elif self.nonneg:
+                np.subtract(tmp, threshold, out=z)
+                np.maximum(z, 0, out=z)
+            else:
+                np.abs(tmp, out=z)
+                np.subtract(z, threshold, out=z)
+                np.maximum(z, 0, out=z)
+                np.copysign(z, tmp, out=z)
+
+            np.subtract(w, z, out=w)
+            change = float(np.sqrt(np.vdot(w, w)))
+            np.subtract(x, z, out=tmp)
+            np.add(u, tmp, out=u)
+            primal = float(np.sqrt(np.vdot(tmp, tmp)))
+            limit = self.tol * max(float(np.sqrt(np.vdot(z, z))), 1e-30)
+            if primal <= limit and change <= limit:
+                break
+        self.iterations = k + 1
+        cost = self.startCost[warm]
+        self.startCost[warm] = self.iterations if cost is None else cost + START_WEIGHT * (self.iterations - cost)
+        np.copyto(self.out, z)
+        return self.out
+
+    def tv_prox(self, v, theta: float, out):
+        # Chambolle's dual projection for min 1/2 ||x - v||^2 + theta TV(x), x = v - theta div p; the dual p
+        # carries over between ADMM iterations of a frame, so a few steps per iteration are enough
+        p, g, div, g_norm = self.p, self.g, self.div, self.gNorm
+        if theta <= 0:
+            np.copyto(out, v)
+            return out
+        for _i in range(self.tvIter):
+            self.divergence(p, div)
+            np.divide(v, theta, out=g_norm)
+            np.subtract(div, g_norm, out=div)
+            g[0, :, :-1] = div[:, 1:] - div[:, :-1]
+            g[0, :, -1] = 0
+            g[1, :-1, :] = div[1:, :] - div[:-1, :]
+            g[1, -1, :] = 0
+            np.hypot(g[0], g[1], out=g_norm)
+            np.multiply(g_norm, 0.25, out=g_norm)
+            g_norm += 1
+            np.multiply(g, 0.25, out=g)
+            np.add(p, g, out=p)
+            np.divide(p, g_norm, out=p)
+        self.divergence(p, div)
+        np.multiply(div, theta, out=div)
+        np.subtract(v, div, out=out)
+        return out
+
+    @staticmethod
+    def divergence(p, out):
+        # Negative adjoint of the forward difference gradient
+        out[:, 0] = p[0, :, 0]
+        out[:, 1:-1] = p[0, :, 1:-1] - p[0, :, :-2]
+        out[:, -1] = -p[0, :, -2]
+        out[0, :] += p[1, 0, :]
+        out[1:-1, :] += p[1, 1:-1, :] - p[1, :-2, :]
+        out[-1, :] -= p[1, -2, :]
+        return out
+
+    def process_batch(self, frames, out=None, block=None):
+        # Frame by frame, so each one warm starts from the last
+        k = len(frames)
+        if out is None:
+            out = np.empty((k, ) + self.sceneShape, dtype=self.dType)
+        for i in range(k):
+            out[i] = self.process(frames[i])
+        return out
+
+
+def make_engine(factors: dict, lmbd, solver=None):
+    if solver is not None and solver.get('solver') == 'admm':
+        return AdmmEngine(factors, lmbd, solver['tau'], solver['prior'], solver['max_iter'], solver['tol'],
+                          solver['rho'])
+    return TikhonovEngine(factors, lmbd)
+
+
+def lambda_scores(y_hat, sigma, lambdas, y_norm: float, sensor_shape):
+    # With orthonormal singular vectors both norms live in the projected space: the filter factors are
+    # f = s^2 / (s^2 + lambda), the residual is ||(1 - f) y_hat||^2 plus the part of Y outside the singular bases
+    # and ||X|| = ||f y_hat / s||. GCV is residual / (pixels - sum(f))^2; the L-curve corner is the point of
+    # largest curvature of (log residual, log ||X||) along log lambda.
+    y_hat = np.asarray(y_hat, dtype='float64')
+    s2 = np.square(np.asarray(sigma, dtype='float64'))
+    outside = max(0.0, y_norm - float(np.square(y_hat).sum()))
+    pixels = sensor_shape[0] * sensor_shape[1]
+    residual = np.empty(len(lambdas))
+    norm = np.empty(len(lambdas))
+    gcv = np.empty(len(lambdas))
+    for i, lmbd in enumerate(lambdas):
+        f = s2 / (s2 + lmbd)
+        residual[i] = float(np.square((1 - f) * y_hat).sum()) + outside
+        norm[i] = float(np.square(np.sqrt(s2) / (s2 + lmbd) * y_hat).sum())
+        gcv[i] = pixels * residual[i] / (pixels - f.sum()) ** 2
+    res = {'lambda': np.asarray(lambdas).tolist(), 'residual': np.sqrt(residual).tolist(),
+           'norm': np.sqrt(norm).tolist(), 'gcv': gcv.tolist(), 'best_gcv': float(lambdas[int(np.argmin(gcv))])}
+    if len(lambdas) >= 3:
+        t = np.log(lambdas)
+        x = 0.5 * np.log(residual)
+        y = 0.5 * np.log(norm)
+        dx, dy = np.gradient(x, t), np.gradient(y, t)
+        ddx, ddy = np.gradient(dx, t), np.gradient(dy, t)
+        speed2 = dx * dx + dy * dy
+        curvature = (dx * ddy - ddx * dy) / np.power(np.maximum(speed2, 1e-300), 1.5)
+        # Where the curve barely moves (lambda far below the noise floor) the curvature is only rounding noise
+        curvature[speed2 < 1e-4 * speed2.max()] = -np.inf
+        res['curvature'] = curvature.tolist()
+        res['best_lcurve'] = float(lambdas[int(np.argmax(curvature[1:-1])) + 1])
+    return res
+
+
+def parse_lambdas(spec: str):
+    # 'start:stop:count' is a log spaced range, anything else a comma separated list
+    if ':' in spec:
+        start, stop, count = spec.split(':')
+        return np.logspace(np.log10(float(start)), np.log10(float(stop)), int(count))
+    return np.array([float(v) for v in spec.split(',')])
+
+
+def output_path(fname: str, shape, d_type: str):
+    # Recon_<SN>__<m>x<n>-<dtype>.npy next to the camera's Cam_<SN>__<W>x<H>-<fmt>.npy ring
+    return os.path.join(os.path.dirname(os.path.abspath(fname)), 'Recon_' + camera_key(fname)['serial'] + '__' +
+                        str(shape[1]) + 'x' + str(shape[0]) + '-' + d_type + '.npy')
+
+
+class OutputChannel(ImageSource):
+    # Reconstructions go into a frame ring of their own and subscribers of the reconstructor's FrameServer get
+    # the same ActiveFile line and cap/binary notifications as subscribers of a camera, so they read them in place
+
+    # The main loop swaps the ring while the server thread answers subscribers from it; the lock keeps a
+    # subscriber from being sent the ActiveFile of a ring that is being closed. Only the main loop writes the
+    # ring, so publish() needs no lock.
+
+    def __init__(self, server: FrameServer, slots=4):
+        ImageSource.__init__(self)
+        self.server = server
+        self.slots = slots
+        self.fname = None
+        self.serial = None
+        self.ring = None
+        self.lock = Lock()
+
+    def open(self, camera_fname: str, shape, d_type='float32'):
+        with self.lock:
+            self.close_ring()
+            self.fname = output_path(camera_fname, shape, d_type)
+            self.serial = camera_key(camera_fname)['serial']
+            self.ring = FrameRing.create(self.fname, shape[0], shape[1], d_type, self.slots)
+            message = self.active_file_message()
+        self.server.announce(self, message)
+        logging.info('Publishing reconstructions to ' + self.fname)
+
+    def active_file_message(self):
+        return active_file_message(self.fname, self.ring.H, self.ring.W, self.ring.dType, self.slots)
+
+    def active_file(self):
+        # From the server thread; None while there is no ring
+        with self.lock:
+            return self.active_file_message() if self.ring is not None else None
+
+    def frames(self):
+        with self.lock:
+            return self.ring.writeSeq if self.ring is not None else 0
+
+    def publish(self, out, timestamp: int, host_time: float, dropped: int):
+        if self.ring is None:
+            return
+        seq, frame = self.ring.begin_write()
+        np.copyto(frame, out, casting='unsafe')
+        self.ring.commit(seq, timestamp, host_time)
+        self.server.publish(self, FrameNote(seq, self.ring.slot_of(seq), timestamp, dropped), time())
+
+    def close(self):
+        with self.lock:
+            self.close_ring()
+
+    def close_ring(self):
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+
+
+def parse_message(message: str, client):
+    global output, frameStats
+    # Same commands as the CameraGrabber for the reconstructed stream; a serial, if given, must be the camera
+    # being reconstructed
+    parts = message.split(':')
+    cmd = parts[0]
+    options = [option for option in parts[1:] if option != output.serial]
+    if 'framedonotify' in cmd:
+        # framedonotify[:<serial>][:binary][:latest|:<queue depth>]
+        try:
+            binary, depth = parse_notify_options(options)
+        except ValueError as e:
+            client.send((str(e) + '\n').encode('utf-8'))
+            return
+        output.add_image_client(client, binary, depth)
+        logging.info('Frame Client Added :' + str(client.getpeername()) + (' (binary)' if binary else ''))
+        message = output.active_file()
+        if message is not None:
+            client.send(message)
+    elif 'framenonotify' in cmd:
+        output.rem_image_client(client)
+        client.send(b'Unsubscribed\n')
+    elif 'activefile' in cmd:
+        message = output.active_file()
+        client.send(message if message is not None else b'No active file\n')
+    elif 'stats' in cmd:
+        stats = {'serial': output.serial, 'frames': output.frames(),
+                 'skipped': frameStats.skipped, 'clients': [output.server.client_stats(c) for c in output.imageClients]}
+        client.send(('Stats:' + json.dumps(stats) + '\n').encode('utf-8'))
+
+
+def rem_image_client(client):
+    global output
+    output.rem_image_client(client)
 
 
 def shutdown():
     global connected, MMFile
     connected = False
     if MMFile is not None:
-        del MMFile
+        MMFile.close()
 
 
-def check_socket(s: socket):
+def check_socket(s: socket, wake=()):
+    # Also returns early when one of `wake` (the pool's result pipes) becomes readable
     packet = b''
-    r, _w, _e = select([s, ], [], [], 0.01)
-    for c in r:
+    r, _w, _e = select([s, ] + list(wake), [], [], 0.01)
+    if s not in r:
+        return packet
+    try:
+        packet = s.recv(65536)
+    except ConnectionResetError as e:
+        logging.debug(e)
         try:
-            packet = c.recv(1024)
-        except ConnectionResetError as e:
+            s.shutdown(socket.SHUT_RDWR)
+        except OSError as e:
             logging.debug(e)
+        finally:
+            s.close()
+            logging.info('CameraGrabber Connection Lost - Shutting down')
+            shutdown()
+    else:
+        if len(packet) == 0:
             try:
-                c.shutdown(socket.SHUT_RDWR)
+                s.shutdown(socket.SHUT_RDWR)
             except OSError as e:
                 logging.debug(e)
             finally:
-                c.close()
+                s.close()
                 logging.info('CameraGrabber Connection Lost - Shutting down')
                 shutdown()
-        else:
-            if len(packet) == 0:
-                try:
-                    c.shutdown(socket.SHUT_RDWR)
-                except OSError as e:
-                    logging.debug(e)
-                finally:
-                    c.close()
-                    logging.info('CameraGrabber Connection Lost - Shutting down')
-                    shutdown()
     return packet
 
 
-def process_image():
-    global MMFile
-    pass
+def process_image(seq: int):
+    global MMFile, engine
+    # Returns the reconstruction with the frame's timestamp and host time, read together with the frame
+    if MMFile is None or engine is None:
+        return None, 0, 0.0
+    frame = MMFile.view(seq)
+    if frame is None:
+        return None, 0, 0.0
+    timestamp, host_time = MMFile.info(seq)
+    out = engine.process(frame)
+    if isinstance(engine, AdmmEngine):
+        logging.debug('ADMM iterations: ' + str(engine.iterations))
+    # The slot may have been reused by the grabber while we were reading it
+    if not MMFile.valid(seq):
+        logging.debug('Frame ' + str(seq) + ' overwritten during reconstruction')
+        return None, 0, 0.0
+    return out, timestamp, host_time
+
+
+def process_batch(frames, out=None):
+    global engine
+    if engine is None:
+        return None
+    return engine.process_batch(frames, out)
+
+
+class FrameStats:
+
+    def __init__(self):
+        self.lastSeq = 0
+        self.skipped = 0
+        self.frameTimes = [0] * 10
+        self.ages = [0] * 10
+        self.counter = 0
+
+    def reset(self):
+        self.lastSeq = 0
+
+
+def frame_done(seq: int, out, duration: float, timestamp: int, host_time: float):
+    global frameStats, output
+    fs = frameStats
+    skipped = seq - fs.lastSeq - 1 if fs.lastSeq > 0 else 0
+    fs.lastSeq = seq
+    fs.skipped += max(0, skipped)
+    fs.frameTimes[fs.counter] = duration
+    if out is None:
+        return None
+    # host_time is stamped by the grabber right after the frame landed in the ring; it was read along with the
+    # frame, as by now the slot may hold a newer one
+    if output is not None:
+        output.publish(out, timestamp, host_time, fs.skipped)
+    fs.ages[fs.counter] = time() - host_time
+    logging.debug('Frame ' + str(seq) + ' skipped ' + str(skipped) + ' age ' + str(fs.ages[fs.counter]) + ' s')
+    fs.counter = (fs.counter + 1) % 10
+    if fs.counter == 9:
+        logging.info('Reconstruction FPS: ' + str(10 / sum(fs.frameTimes)) + ', mean age: ' +
+                     str(sum(fs.ages) / 10) + ' s, skipped: ' + str(fs.skipped))
+    return out
+
+
+def newest_frame(note: FrameNote):
+    global MMFile, frameStats
+    if MMFile is None:
+        return None
+    # The ring may already hold frames whose notifications have not arrived yet; when an earlier round already
+    # jumped ahead to them their notifications only come in now and there is nothing new to reconstruct
+    seq = max(note.seq, MMFile.latest_seq())
+    if seq <= frameStats.lastSeq:
+        return None
+    if seq > note.seq:
+        note = note._replace(seq=seq, slot=MMFile.slot_of(seq))
+    return note
+
+
+def reconstruct(note: FrameNote):
+    start = perf_counter()
+    out, timestamp, host_time = process_image(note.seq)
+    return frame_done(note.seq, out, perf_counter() - start, timestamp, host_time)
+
+
+def pool_worker(ring_fname: str, calib_dir: str, lmbd, solver, tasks, results):
+    ring = FrameRing(ring_fname)
+    worker_engine = make_engine(load_cache(calib_dir), lmbd, solver)
+    while True:
+        seq = tasks.get()
+        if seq is None:
+            break
+        out = None
+        timestamp, host_time = 0, 0.0
+        frame = ring.view(seq)
+        if frame is not None:
+            # The slot's times go with the frame; once the result is back the grabber may have reused the slot
+            timestamp, host_time = ring.info(seq)
+            out = worker_engine.process(frame)
+            if not ring.valid(seq):
+                out = None
+        # The pipe pickles before send() returns, so the reused output buffer can go as it is
+        results.send((seq, out, timestamp, host_time))
+    results.close()
+    ring.close()
+
+
+class ReconstructionPool:
+    # Worker processes map the same frame ring and calibration cache, take sequence numbers from a shared task
+    # queue and return their reconstructions through a pipe each, which the main loop waits on along with the
+    # grabber's socket; collect() hands them back in frame order. A frame that is still being worked on is only
+    # given up on once a later frame's result has waited behind it for longer than maxDelay, so a solver slower
+    # than maxDelay still gets every frame out and one slow frame cannot hold back the rest for long.
+
+    def __init__(self, workers: int, ring_fname: str, calib_dir: str, lmbd, max_delay=0.1, solver=None):
+        self.maxDelay = max_delay
+        self.tasks = mp.Queue()
+        self.inflight = deque()
+        self.done = dict()
+        self.lastOut = perf_counter()
+        self.readers = []
+        self.workers = []
+        for _i in range(workers):
+            reader, writer = mp.Pipe(duplex=False)
+            self.readers.append(reader)
+            self.workers.append(mp.Process(target=pool_worker,
+                                           args=(ring_fname, calib_dir, lmbd, solver, self.tasks, writer),
+                                           daemon=True))
+            self.workers[-1].start()
+            writer.close()
+
+    def busy(self):
+        return len(self.inflight) >= 2 * len(self.workers)
+
+    def submit(self, seq: int):
+        self.inflight.append(seq)
+        self.tasks.put(seq)
+
+    def collect(self):
+        now = perf_counter()
+        for reader in list(self.readers):
+            try:
+                while reader.poll():
+                    seq, out, timestamp, host_time = reader.recv()
+                    self.done[seq] = (out, timestamp, host_time, now)
+            except (EOFError, OSError):
+                logging.error('A reconstruction worker has exited')
+                self.readers.remove(reader)
+        ready = []
+        while self.inflight:
+            seq = self.inflight[0]
+            if seq in self.done:
+                out, timestamp, host_time, _arrived = self.done.pop(seq)
+                ready.append((seq, out, timestamp, host_time, now - self.lastOut))
+                self.lastOut = now
+            elif self.done and now - min([r[3] for r in self.done.values()]) > self.maxDelay:
+                logging.debug('Frame ' + str(seq) + ' held back later frames beyond the reorder delay')
+            else:
+                break
+            self.inflight.popleft()
+        # Results for frames that were given up on
+        oldest = self.inflight[0] if self.inflight else None
+        for seq in [k for k in self.done if oldest is None or k < oldest]:
+            del self.done[seq]
+        return ready
+
+    def close(self):
+        for _w in self.workers:
+            self.tasks.put(None)
+        for w in self.workers:
+            w.join(1)
+            if w.is_alive():
+                w.terminate()
+        for reader in self.readers:
+            reader.close()
 
 
 if __name__ == '__main__':
@@ -54,6 +672,33 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-l', '--log_level', help='Specify log verbosity')
+    parser.add_argument('-c', '--calibration', help='Calibration file (.npz with PhiL and PhiR), cached per camera')
+    parser.add_argument('--lmbd', type=float, default=1e-2, help='Tikhonov regularization weight')
+    parser.add_argument('--solver', default='tikhonov', choices=['tikhonov', 'admm'],
+                        help='Closed form Tikhonov, or ADMM with a TV or L1 prior warm started from the last frame')
+    parser.add_argument('--prior', default='tv', choices=['tv', 'l1'], help='Prior of the ADMM solver')
+    parser.add_argument('--tau', type=float, default=1e-4,
+                        help='ADMM prior weight, relative to the largest back projected value')
+    parser.add_argument('--rho', type=float, default=1e-3, help='ADMM penalty, relative to the largest S^2')
+    parser.add_argument('--max_iter', type=int, default=50, help='ADMM iterations per frame at most')
+    parser.add_argument('--tol', type=float, default=1e-3, help='ADMM relative convergence tolerance')
+    parser.add_argument('--every', action='store_true',
+                        help='Reconstruct every notified frame instead of only the newest pending one')
+    parser.add_argument('-s', '--serial', help='Serial number of the camera to reconstruct, the first one by default')
+    parser.add_argument('-i', '--input',
+                        help='Reconstruct a recording or a stack of frames (.npy, K x H x W) offline and exit')
+    parser.add_argument('-o', '--output', default='reconstruction.npy', help='Output file for --input')
+    parser.add_argument('--sweep', help='Reconstruct one --input frame for many lambdas, start:stop:count (log spaced) '
+                                        'or a comma separated list, and score them')
+    parser.add_argument('--frame', type=int, default=0, help='Frame of --input to sweep')
+    parser.add_argument('-w', '--workers', type=int, default=0, help='Reconstruct in a pool of worker processes')
+    parser.add_argument('--max_delay', type=float, default=0.1,
+                        help='Longest a pooled frame may hold back later ones before it is skipped (s)')
+    parser.add_argument('-p', '--port', type=lambda x: int(x, 0), default=OUTPUT_PORT,
+                        help='Port subscribers get reconstructed frames from')
+    parser.add_argument('--out_slots', type=int, default=4, help='Number of frame slots in the output ring')
+    parser.add_argument('-q', '--queue_depth', type=int, default=4,
+                        help='Frame notifications kept per subscriber before the oldest are dropped')
 
     args = parser.parse_args()
     if args.log_level:
@@ -70,6 +715,44 @@ if __name__ == '__main__':
     else:
         logging.basicConfig(level=logging.WARNING)
 
+    solver = {'solver': args.solver, 'prior': args.prior, 'tau': args.tau, 'rho': args.rho, 'max_iter': args.max_iter,
+              'tol': args.tol}
+    if args.input:
+        if os.path.isdir(args.input):
+            frames = Recording(args.input)
+            fname = frames.meta['fname']
+        else:
+            frames = np.load(args.input, mmap_mode='r')
+            fname = args.input
+        factors = open_calibration(fname, frames.shape[1:], args.calibration, args.lmbd)
+        if factors is None:
+            logging.critical('No calibration for ' + args.input)
+            sys.exit(1)
+        engine = make_engine(factors, args.lmbd, solver)
+        if args.sweep:
+            lambdas = parse_lambdas(args.sweep)
+            start = perf_counter()
+            out, scores = engine.sweep(frames[args.frame], lambdas)
+            duration = perf_counter() - start
+            np.save(args.output, out)
+            print('lambda residual norm gcv' + (' curvature' if 'curvature' in scores else ''))
+            for i, lmbd in enumerate(lambdas):
+                print(' '.join([str(lmbd), str(scores['residual'][i]), str(scores['norm'][i]), str(scores['gcv'][i])] +
+                               ([str(scores['curvature'][i])] if 'curvature' in scores else [])))
+            print('GCV picks ' + str(scores['best_gcv']) +
+                  (', L-curve picks ' + str(scores['best_lcurve']) if 'best_lcurve' in scores else '') + ' (' +
+                  str(len(lambdas)) + ' lambdas in ' + str(duration) + ' s)')
+            sys.exit(0)
+        out = np.lib.format.open_memmap(args.output, mode='w+', dtype=engine.dType,
+                                        shape=(len(frames), ) + engine.sceneShape)
+        start = perf_counter()
+        process_batch(frames, out)
+        out.flush()
+        duration = perf_counter() - start
+        print('Reconstructed ' + str(len(frames)) + ' frames in ' + str(duration) + ' s (' +
+              str(len(frames) / duration) + ' FPS)')
+        sys.exit(0)
+
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     try:
         sock.connect(('127.0.0.1', 0xFC4D))
@@ -77,29 +760,86 @@ if __name__ == '__main__':
         logging.critical('Cannot connect to CameraGrabber')
         sys.exit(0)
 
+    engine = None
     connected = True
     MMFile = None
-    stream = []
+    notifications = NotificationParser()
+    frameStats = FrameStats()
+    pool = None
+    waiting = deque()
+    server = FrameServer(('127.0.0.1', args.port), parse_message, rem_image_client, args.queue_depth)
+    output = OutputChannel(server, args.out_slots)
+    serverThread = Thread(target=server.serve, args=(lambda: not connected, ))
+    serverThread.start()
 
-    sock.send(b'framedonotify\n')
+    cam = ':' + args.serial if args.serial else ''
+    if args.every:
+        sock.send(('framedonotify' + cam + ':binary\n').encode('utf-8'))
+    else:
+        sock.send(('framedonotify' + cam + ':binary:latest\n').encode('utf-8'))
     while connected:
-        stream += check_socket(sock).decode('utf-8')
         try:
-            message, stream = stream.split('\n', 1)
-        except ValueError:
-            continue
+            events = notifications.feed(check_socket(sock, pool.readers if pool is not None else ()))
         except Exception as e:
             logging.error(e)
             shutdown()
-        else:
-            if 'ActiveFile' in message:
-                parts = message.split(':')
+            continue
+        newest = None
+        for message in events:
+            if isinstance(message, FrameNote):
+                if pool is not None:
+                    if not args.every:
+                        waiting.clear()
+                    waiting.append(message.seq)
+                elif args.every:
+                    reconstruct(message)
+                else:
+                    newest = message
+            elif 'ActiveFile' in message:
+                newest = None
+                waiting.clear()
+                if pool is not None:
+                    pool.close()
+                    pool = None
+                frameStats.reset()
+                fname = parse_active_file(message)[0]
                 if MMFile is not None:
-                    del MMFile
-                MMFile = np.memmap(parts[1], mode='r', shape=(parts[2], parts[3]), dtype=parts[4])
-            elif 'cap' in message:
-                process_image()
+                    MMFile.close()
+                MMFile = FrameRing(fname)
+                engine = None
+                start = perf_counter()
+                try:
+                    factors = open_calibration(fname, MMFile.shape, args.calibration, args.lmbd)
+                except (OSError, KeyError, ValueError) as e:
+                    logging.error(e)
+                    factors = None
+                if factors is not None and args.workers > 0:
+                    pool = ReconstructionPool(args.workers, fname, cache_path(fname), args.lmbd, args.max_delay,
+                                              solver)
+                    logging.info('Started ' + str(args.workers) + ' reconstruction workers')
+                elif factors is not None:
+                    engine = make_engine(factors, args.lmbd, solver)
+                    logging.info('Calibration loaded in ' + str(perf_counter() - start) + ' s')
+                else:
+                    logging.warning('No calibration for ' + fname)
+                if factors is not None:
+                    output.open(fname, (factors['VL'].shape[0], factors['VR'].shape[0]))
+        if newest is not None:
+            newest = newest_frame(newest)
+        if newest is not None:
+            reconstruct(newest)
+        if pool is not None:
+            while waiting and not pool.busy():
+                pool.submit(waiting.popleft())
+            for seq, out, timestamp, host_time, duration in pool.collect():
+                frame_done(seq, out, duration, timestamp, host_time)
 
+    if pool is not None:
+        pool.close()
+    server.wake()
+    serverThread.join()
+    server.close()
+    output.close()
     try:
         sock.shutdown(socket.SHUT_RDWR)
     except OSError as e:
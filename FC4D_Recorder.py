@@ -0,0 +1,192 @@
+import glob
+import json
+import logging
+import os
+import numpy as np
+from collections import deque
+from queue import Queue
+from threading import Thread
+from time import time, strftime, localtime
+from FC4D_Calibration import camera_key
+from FC4D_Stats import RollingStat, clock
+
+# A recording is a directory with meta.json, an append-only index.bin of recordIndex entries (one per frame) and
+# chunk_NNNNN.raw files holding chunkFrames raw frames each, back to back, so every part can be memory mapped
+# while it is still being written
+
+RECORDING_VERSION = 1
+recordIndex = np.dtype([('seq', '<u8'), ('timestamp', '<u8'), ('hostTime', '<f8'), ('dropped', '<u8')])
+
+
+def recording_path(directory: str, fname: str):
+    # Rec_<SN>_<date>-<time>.<ms>, with a counter on the end should that exist already
+    key = camera_key(fname)
+    now = time()
+    base = os.path.join(os.path.abspath(directory), 'Rec_' + key['serial'] + '_' +
+                        strftime('%Y%m%d-%H%M%S', localtime(now)) + '.' + str(int(now * 1000) % 1000).zfill(3))
+    path = base
+    n = 1
+    while os.path.exists(path):
+        path = base + '-' + str(n)
+        n += 1
+    return path
+
+
+def chunk_name(path: str, chunk: int):
+    return os.path.join(path, 'chunk_' + str(chunk).zfill(5) + '.raw')
+
+
+def read_meta(path: str):
+    with open(os.path.join(path, 'meta.json'), 'r') as f:
+        return json.load(f)
+
+
+def write_meta(path: str, meta: dict):
+    tmp = os.path.join(path, 'meta.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(meta, f, indent=1)
+    os.replace(tmp, os.path.join(path, 'meta.json'))
+
+
+class Recorder:
+    # grab_frames only copies a frame into a free buffer and queues it; the writer thread appends queued frames to
+    # the chunk files and hands the buffers back. When the disk falls behind and no buffer is free the frame is
+    # left out of the recording (counted in skipped) instead of holding up the grab loop.
+
+    def __init__(self, path: str, fname: str, shape, d_type: str, limit=0, buffers=64, chunk_frames=256,
+                 info=None):
+        self.path = path
+        self.shape = tuple(shape)
+        self.dType = d_type
+        self.limit = limit
+        self.chunkFrames = chunk_frames
+        self.free = deque([np.empty(self.shape, dtype=d_type) for _i in range(buffers)])
+        self.filled = Queue()
+        self.queued = 0
+        self.written = 0
+        self.skipped = 0
+        self.recording = True
+        self.writeStat = RollingStat()
+        self.chunk = None
+        self.chunkIndex = -1
+        self.chunkCount = 0
+        self.entry = np.zeros(1, dtype=recordIndex)
+
+        os.makedirs(path)
+        self.meta = {'version': RECORDING_VERSION, 'fname': fname, 'shape': list(self.shape), 'dType': d_type,
+                     'chunkFrames': chunk_frames, 'started': time(), 'frames': 0, 'skipped': 0, 'complete': False}
+        if info is not None:
+            self.meta.update(info)
+        write_meta(path, self.meta)
+        self.index = open(os.path.join(path, 'index.bin'), 'wb')
+        self.writer = Thread(target=self.write_frames)
+        self.writer.start()
+        logging.info('Recording to ' + path)
+
+    def add(self, frame, seq: int, timestamp: int, host_time: float, dropped: int):
+        # Called from the grab thread; returns False once the recording has ended
+        if not self.recording:
+            return False
+        if self.limit and self.queued >= self.limit:
+            self.stop()
+            return False
+        try:
+            buf = self.free.popleft()
+        except IndexError:
+            self.skipped += 1
+            return True
+        np.copyto(buf, frame)
+        self.queued += 1
+        self.filled.put((buf, seq, timestamp, host_time, dropped))
+        return True
+
+    def stop(self):
+        if self.recording:
+            self.recording = False
+            self.filled.put(None)
+
+    def close(self):
+        self.stop()
+        self.writer.join()
+
+    def next_chunk(self):
+        if self.chunk is not None:
+            self.chunk.close()
+        self.chunkIndex += 1
+        self.chunkCount = 0
+        self.chunk = open(chunk_name(self.path, self.chunkIndex), 'wb')
+
+    def write_frames(self):
+        while True:
+            item = self.filled.get()
+            if item is None:
+                break
+            buf, seq, timestamp, host_time, dropped = item
+            start = clock()
+            if self.chunk is None or self.chunkCount == self.chunkFrames:
+                self.next_chunk()
+            self.chunk.write(buf.data)
+            self.entry[0] = (seq, timestamp, host_time, dropped)
+            self.index.write(self.entry.data)
+            self.chunkCount += 1
+            self.written += 1
+            self.free.append(buf)
+            self.writeStat.add(clock() - start)
+        if self.chunk is not None:
+            self.chunk.close()
+        self.index.close()
+        self.meta.update({'frames': self.written, 'skipped': self.skipped, 'stopped': time(), 'complete': True})
+        write_meta(self.path, self.meta)
+        logging.info('Recorded ' + str(self.written) + ' frames (' + str(self.skipped) + ' skipped) to ' + self.path)
+
+    def stats(self):
+        return {'path': self.path, 'recording': self.recording, 'queued': self.queued, 'written': self.written,
+                'skipped': self.skipped, 'buffered': self.filled.qsize(), 'write': self.writeStat.summary()}
+
+
+class Recording:
+    # Read side: frames are indexed across chunks like a (frames, H, W) array; slices within one chunk are views
+
+    def __init__(self, path: str):
+        self.path = path
+        self.meta = read_meta(path)
+        if self.meta.get('version') != RECORDING_VERSION:
+            raise ValueError(path + ' has recording version ' + str(self.meta.get('version')))
+        h, w = self.meta['shape']
+        self.dType = self.meta['dType']
+        self.chunkFrames = self.meta['chunkFrames']
+        self.index = np.fromfile(os.path.join(path, 'index.bin'), dtype=recordIndex)
+        frame_bytes = h * w * np.dtype(self.dType).itemsize
+        self.chunks = []
+        count = 0
+        for name in sorted(glob.glob(os.path.join(path, 'chunk_*.raw'))):
+            n = os.path.getsize(name) // frame_bytes
+            if n == 0:
+                break
+            self.chunks.append(np.memmap(name, dtype=self.dType, mode='r', shape=(n, h, w)))
+            count += n
+        count = min(count, len(self.index))
+        self.index = self.index[:count]
+        self.shape = (count, h, w)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start, stop, step = item.indices(len(self))
+            if step != 1:
+                return np.stack([self[i] for i in range(start, stop, step)])
+            if stop <= start:
+                return np.empty((0, ) + self.shape[1:], dtype=self.dType)
+            first, last = start // self.chunkFrames, (stop - 1) // self.chunkFrames
+            if first == last:
+                offset = first * self.chunkFrames
+                return self.chunks[first][start - offset:stop - offset]
+            bounds = [start] + list(range((first + 1) * self.chunkFrames, stop, self.chunkFrames)) + [stop]
+            return np.concatenate([self[a:b] for a, b in zip(bounds[:-1], bounds[1:])])
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError('Frame ' + str(item) + ' is not in the recording')
+        return self.chunks[item // self.chunkFrames][item % self.chunkFrames]
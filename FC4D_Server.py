@@ -0,0 +1,268 @@
+import logging
+import selectors
+import socket
+from collections import deque
+from FC4D_Protocol import cap_message, pack_notifications
+from FC4D_Stats import RollingStat, clock
+
+
+class ClientConnection:
+
+    def __init__(self, sock: socket.socket, server):
+        self.sock = sock
+        self.server = server
+        self.peername = sock.getpeername()
+        self.stream = b''
+        self.outbuf = bytearray()
+        self.binary = False
+        self.depth = server.queueDepth
+        self.notes = dict()
+        self.dropped = 0
+        self.sendStat = RollingStat()
+        self.depthStat = RollingStat()
+        self.connected = True
+
+    def set_queue_depth(self, depth: int):
+        self.depth = max(1, depth)
+        for camera, queue in self.notes.items():
+            self.notes[camera] = deque(queue, maxlen=self.depth)
+
+    def queue_for(self, camera: int):
+        queue = self.notes.get(camera)
+        if queue is None:
+            queue = self.notes[camera] = deque(maxlen=self.depth)
+        return queue
+
+    def queued(self):
+        return sum([len(queue) for queue in self.notes.values()])
+
+    def getpeername(self):
+        return self.peername
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, data: bytes):
+        if not self.connected:
+            return 0
+        self.outbuf += data
+        self.server.flush_client(self)
+        return len(data)
+
+    def sendall(self, data: bytes):
+        self.send(data)
+
+    def close(self):
+        self.server.drop_client(self)
+
+
+class ImageSource:
+    # Something subscribers get frame notifications for (a camera, the reconstructor's output); FrameServer.publish
+    # and announce send to its imageClients
+
+    def __init__(self):
+        self.imageClients = []
+
+    def add_image_client(self, image_client, binary=False, depth=None):
+        image_client.binary = binary
+        if depth is not None:
+            image_client.set_queue_depth(depth)
+        if not image_client in self.imageClients:
+            self.imageClients.append(image_client)
+
+    def rem_image_client(self, image_client):
+        if image_client in self.imageClients:
+            self.imageClients.remove(image_client)
+
+
+class FrameServer:
+    # One selector loop accepts clients, reads commands, hands complete lines to the handler and writes
+    # queued replies and frame notifications. Grab threads only call publish(), which wakes the loop.
+    # Every subscriber has a bounded notification queue per camera that keeps the newest frames; frames pushed
+    # out of a full queue are counted as dropped for that subscriber and nothing ever waits on a slow socket.
+
+    def __init__(self, address, handler, disconnect_handler=None, queue_depth=4):
+        self.handler = handler
+        self.disconnectHandler = disconnect_handler
+        self.queueDepth = max(1, queue_depth)
+        self.selector = selectors.DefaultSelector()
+        self.clients = []
+        self.pending = deque(maxlen=1024)
+        self.pendingStat = RollingStat()
+        self.running = True
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(address)
+        self.listener.listen(128)
+        self.listener.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ, None)
+
+        self.wakeR, self.wakeW = socket.socketpair()
+        self.wakeR.setblocking(False)
+        self.wakeW.setblocking(False)
+        self.selector.register(self.wakeR, selectors.EVENT_READ, None)
+
+    def wake(self):
+        try:
+            self.wakeW.send(b'\0')
+        except OSError:
+            # Buffer full means a wake up is already pending
+            pass
+
+    def publish(self, source, note, host_time: float):
+        # Called from grab threads; source.imageClients is only ever touched by the loop
+        self.pending.append((source, note, host_time))
+        self.wake()
+
+    def announce(self, source, data: bytes):
+        # A text line for every subscriber of source, e.g. a new ActiveFile, kept in order with the notifications
+        self.pending.append((source, data, None))
+        self.wake()
+
+    def serve(self, should_stop):
+        while self.running and not should_stop():
+            for key, mask in self.selector.select():
+                if key.fileobj is self.listener:
+                    self.accept()
+                elif key.fileobj is self.wakeR:
+                    self.drain_wake()
+                else:
+                    client = key.data
+                    if mask & selectors.EVENT_READ:
+                        self.read_client(client)
+                    if mask & selectors.EVENT_WRITE and client.connected:
+                        self.flush_client(client)
+            self.flush_notifications()
+
+    def accept(self):
+        try:
+            sock, addr = self.listener.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        logging.info('Client connected @' + str(addr))
+        client = ClientConnection(sock, self)
+        self.clients.append(client)
+        self.selector.register(sock, selectors.EVENT_READ, client)
+        client.send('connected\n'.encode('utf-8'))
+
+    def drain_wake(self):
+        try:
+            while self.wakeR.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def read_client(self, client: ClientConnection):
+        try:
+            data = client.sock.recv(4096)
+        except BlockingIOError:
+            return
+        except (ConnectionResetError, OSError) as e:
+            logging.debug(e)
+            data = b''
+        if len(data) == 0:
+            self.drop_client(client)
+            return
+        logging.debug('Data received: ' + data.decode('utf-8', 'replace'))
+        client.stream += data
+        while b'\n' in client.stream and client.connected and self.running:
+            message, client.stream = client.stream.split(b'\n', 1)
+            # This loop serves every camera and subscriber, so whatever one client sends must not end it
+            try:
+                self.handler(message.decode('utf-8', 'replace'), client)
+            except Exception as e:
+                logging.exception('Command from ' + str(client.peername) + ' failed')
+                client.send(('Error: ' + str(e) + '\n').encode('utf-8'))
+
+    def flush_client(self, client: ClientConnection):
+        if not client.connected:
+            return
+        while client.outbuf or client.queued():
+            if not client.outbuf:
+                self.write_notes(client)
+            start = clock()
+            try:
+                sent = client.sock.send(client.outbuf)
+            except BlockingIOError:
+                client.sendStat.add(clock() - start)
+                break
+            except OSError as e:
+                logging.debug(e)
+                self.drop_client(client)
+                return
+            client.sendStat.add(clock() - start)
+            del client.outbuf[:sent]
+            if client.outbuf:
+                break
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if client.outbuf else 0)
+        if self.selector.get_key(client.sock).events != events:
+            self.selector.modify(client.sock, events, client)
+
+    def write_notes(self, client: ClientConnection):
+        for camera, queue in client.notes.items():
+            if not queue:
+                continue
+            notes = list(queue)
+            queue.clear()
+            if client.binary:
+                client.outbuf += pack_notifications([(note[0], note[1], note[2], note[3] + client.dropped)
+                                                     for note, _t in notes], camera)
+            else:
+                client.outbuf += b''.join([cap_message(t, note[0]) for note, t in notes])
+
+    def flush_notifications(self):
+        if self.pending:
+            self.pendingStat.add(len(self.pending))
+        while self.pending:
+            source, note, host_time = self.pending.popleft()
+            if isinstance(note, bytes):
+                for client in source.imageClients:
+                    self.write_notes(client)
+                    client.outbuf += note
+                continue
+            for client in source.imageClients:
+                queue = client.queue_for(note.camera)
+                if len(queue) == queue.maxlen:
+                    client.dropped += 1
+                queue.append((note, host_time))
+                client.depthStat.add(len(queue))
+        for client in list(self.clients):
+            if client.outbuf or client.queued():
+                self.flush_client(client)
+
+    def drop_client(self, client: ClientConnection):
+        if not client.connected:
+            return
+        client.connected = False
+        try:
+            self.selector.unregister(client.sock)
+        except (KeyError, ValueError):
+            pass
+        try:
+            client.sock.shutdown(socket.SHUT_RDWR)
+        except OSError as e:
+            logging.debug(e)
+        finally:
+            client.sock.close()
+        if client in self.clients:
+            self.clients.remove(client)
+        if self.disconnectHandler is not None:
+            self.disconnectHandler(client)
+        logging.info('Client Disconnected: ' + str(client.peername))
+
+    def client_stats(self, client: ClientConnection):
+        return {'peer': str(client.peername), 'binary': client.binary, 'dropped': client.dropped,
+                'queued': client.queued(), 'queueLimit': client.depth, 'outbuf': len(client.outbuf),
+                'queueDepth': client.depthStat.summary(1, False), 'send': client.sendStat.summary()}
+
+    def close(self):
+        self.running = False
+        for client in list(self.clients):
+            self.drop_client(client)
+        self.selector.close()
+        self.listener.close()
+        self.wakeR.close()
+        self.wakeW.close()
@@ -0,0 +1,131 @@
+import numpy as np
+
+RING_MAGIC = b'FC4DRING'
+RING_VERSION = 1
+PAGE = 4096
+
+ringHeader = np.dtype([('magic', 'S8'), ('version', '<u4'), ('slots', '<u4'), ('height', '<u4'), ('width', '<u4'),
+                       ('dType', 'S8'), ('slotStride', '<u8'), ('dataOffset', '<u8'), ('writeSeq', '<u8')])
+# seqStart is set before a slot is overwritten and seqDone once the frame is complete; a reader holds a full
+# frame only if both equal the sequence number it asked for before and after reading
+slotHeader = np.dtype([('seqStart', '<u8'), ('seqDone', '<u8'), ('timestamp', '<u8'), ('hostTime', '<f8')])
+SLOT_HEADER_SIZE = 64
+
+
+def round_up(n, m=PAGE):
+    return ((n + m - 1) // m) * m
+
+
+class FrameRing:
+
+    def __init__(self, fname: str, mode='r'):
+        self.fname = fname
+        self.writable = mode != 'r'
+        self.mm = np.memmap(fname, dtype='uint8', mode='r+' if self.writable else 'r')
+        self.header = self.mm[:ringHeader.itemsize].view(ringHeader)
+        if self.header['magic'][0] != RING_MAGIC:
+            raise ValueError(fname + ' is not a frame ring')
+        if self.header['version'][0] != RING_VERSION:
+            raise ValueError(fname + ' has ring version ' + str(self.header['version'][0]))
+        self.slots = int(self.header['slots'][0])
+        self.H = int(self.header['height'][0])
+        self.W = int(self.header['width'][0])
+        self.dType = self.header['dType'][0].decode('ascii')
+        self.shape = (self.H, self.W)
+        stride = int(self.header['slotStride'][0])
+        offset = int(self.header['dataOffset'][0])
+        nbytes = self.H * self.W * np.dtype(self.dType).itemsize
+
+        self.slotHeaders = []
+        self.frames = []
+        for i in range(self.slots):
+            start = offset + i * stride
+            self.slotHeaders.append(self.mm[start:start + slotHeader.itemsize].view(slotHeader))
+            data = start + SLOT_HEADER_SIZE
+            self.frames.append(self.mm[data:data + nbytes].view(self.dType).reshape(self.shape))
+        self.writeSeq = int(self.header['writeSeq'][0])
+
+    @staticmethod
+    def create(fname: str, H: int, W: int, dType: str, slots=8):
+        # Reuse a matching ring in place so readers that still have it mapped keep working
+        try:
+            ring = FrameRing(fname, 'r+')
+        except (OSError, ValueError):
+            pass
+        else:
+            if ring.shape == (H, W) and ring.dType == dType and ring.slots == slots:
+                return ring
+            ring.close()
+        nbytes = H * W * np.dtype(dType).itemsize
+        stride = round_up(SLOT_HEADER_SIZE + nbytes)
+        offset = round_up(ringHeader.itemsize)
+        size = offset + stride * slots
+        with open(fname, 'w+b') as f:
+            f.truncate(size)
+        mm = np.memmap(fname, dtype='uint8', mode='r+', shape=(size, ))
+        header = mm[:ringHeader.itemsize].view(ringHeader)
+        header['magic'] = RING_MAGIC
+        header['version'] = RING_VERSION
+        header['slots'] = slots
+        header['height'] = H
+        header['width'] = W
+        header['dType'] = dType.encode('ascii')
+        header['slotStride'] = stride
+        header['dataOffset'] = offset
+        header['writeSeq'] = 0
+        mm.flush()
+        del mm
+        return FrameRing(fname, 'r+')
+
+    def slot_of(self, seq: int):
+        return seq % self.slots
+
+    # Writer side, one writer per ring
+
+    def begin_write(self):
+        seq = self.writeSeq + 1
+        slot = self.slot_of(seq)
+        self.slotHeaders[slot]['seqStart'] = seq
+        return seq, self.frames[slot]
+
+    def commit(self, seq: int, timestamp=0, host_time=0.0):
+        sh = self.slotHeaders[self.slot_of(seq)]
+        sh['timestamp'] = timestamp
+        sh['hostTime'] = host_time
+        sh['seqDone'] = seq
+        self.header['writeSeq'] = seq
+        self.writeSeq = seq
+
+    # Reader side, lock free
+
+    def latest_seq(self):
+        return int(self.header['writeSeq'][0])
+
+    def valid(self, seq: int):
+        sh = self.slotHeaders[self.slot_of(seq)]
+        return int(sh['seqDone'][0]) == seq and int(sh['seqStart'][0]) == seq
+
+    def view(self, seq: int):
+        if not self.valid(seq):
+            return None
+        return self.frames[self.slot_of(seq)]
+
+    def info(self, seq: int):
+        sh = self.slotHeaders[self.slot_of(seq)]
+        return int(sh['timestamp'][0]), float(sh['hostTime'][0])
+
+    def read(self, seq: int, out):
+        if not self.valid(seq):
+            return False
+        np.copyto(out, self.frames[self.slot_of(seq)], casting='unsafe')
+        return self.valid(seq)
+
+    def close(self):
+        self.slotHeaders = []
+        self.frames = []
+        self.header = None
+        if self.mm is not None:
+            if self.writable:
+                self.mm.flush()
+            del self.mm
+            self.mm = None
@@ -0,0 +1,370 @@
+import logging
+import os
+import sys
+import numpy as np
+from contextlib import contextmanager
+from time import perf_counter_ns, sleep
+from FC4D_Packing import PACKED_BITS, pack
+from FC4D_Recorder import Recording
+
+# Stand-in for the parts of pypylon.pylon (and pypylon.genicam) that the FC4D tools use, so the grabber, the
+# reconstructor and the GUI run without a Basler camera: `import FC4D_SimCamera as py`
+
+PixelType_Mono8 = 17301505
+PixelType_Mono10 = 17825795
+PixelType_Mono10p = 17432646
+PixelType_Mono12 = 17825797
+PixelType_Mono12p = 17563719
+PixelType_Mono16 = 17825799
+
+GrabStrategy_OneByOne = 0
+GrabStrategy_LatestImageOnly = 1
+TimeoutHandling_Return = 0
+TimeoutHandling_ThrowException = 1
+
+formatBits = {'Mono8': 8, 'Mono10': 10, 'Mono10p': 10, 'Mono12': 12, 'Mono12p': 12, 'Mono16': 16}
+converterFormats = (PixelType_Mono8, PixelType_Mono16)
+
+settings = {'width': 1280, 'height': 1024, 'pixelFormat': 'Mono12', 'fps': 30.0, 'serial': 'SIM',
+            'devices': 1, 'replay': None, 'replaySpeed': 'original', 'bank': 16, 'binning': True}
+
+
+class GenericException(Exception):
+    pass
+
+
+class RuntimeException(GenericException):
+    pass
+
+
+class TimeoutException(RuntimeException):
+    pass
+
+
+def configure(**kwargs):
+    for key, val in kwargs.items():
+        if key not in settings:
+            raise KeyError('Unknown simulator setting: ' + key)
+        settings[key] = val
+
+
+def add_arguments(parser):
+    parser.add_argument('--simulate', action='store_true', help='Use the simulated camera instead of pypylon')
+    parser.add_argument('--sim_size', default='1280x1024', help='Simulated sensor size, WxH')
+    parser.add_argument('--sim_format', default='Mono12', help='Simulated pixel format (Mono8/10/10p/12/12p/16)')
+    parser.add_argument('--sim_fps', type=float, default=30.0, help='Simulated frame rate')
+    parser.add_argument('--sim_devices', type=int, default=1, help='Number of simulated cameras')
+    parser.add_argument('--replay', help='Replay a recording (directory) or a .npy stack instead of synthesising')
+    parser.add_argument('--replay_speed', default='original', choices=['original', 'max', 'fps'],
+                        help='Replay a recording at its recorded timing, as fast as it is taken, or at --sim_fps')
+    parser.add_argument('--sim_no_binning', action='store_true',
+                        help='Simulate a camera without binning, so the grabber bins in software')
+
+
+def configure_from_args(args):
+    w, h = args.sim_size.lower().split('x')
+    configure(width=int(w), height=int(h), pixelFormat=args.sim_format, fps=args.sim_fps,
+              devices=args.sim_devices, replay=args.replay, replaySpeed=args.replay_speed,
+              binning=not args.sim_no_binning)
+
+
+class Node:
+
+    def __init__(self, value, symbolics=None, writable=True):
+        self.Value = value
+        self.Symbolics = symbolics
+        self.writable = writable
+
+    def __call__(self):
+        return self.Value
+
+    def GetValue(self):
+        return self.Value
+
+    def SetValue(self, value):
+        if not self.writable:
+            raise RuntimeException('Node is not writable')
+        if self.Symbolics is not None and value not in self.Symbolics:
+            raise RuntimeException('Invalid value ' + str(value))
+        self.Value = value
+
+
+class SizeNode(Node):
+    # Width/Height, which can't be set beyond WidthMax/HeightMax
+
+    def __init__(self, value, maximum: Node):
+        Node.__init__(self, value)
+        self.maximum = maximum
+
+    def SetValue(self, value):
+        if value < 1 or value > self.maximum():
+            raise RuntimeException('Value ' + str(value) + ' out of range 1..' + str(self.maximum()))
+        Node.SetValue(self, value)
+
+
+class BinningNode(Node):
+
+    def __init__(self, on_change):
+        Node.__init__(self, 1, [1, 2, 3, 4, 5, 6, 7, 8])
+        self.onChange = on_change
+
+    def SetValue(self, value):
+        Node.SetValue(self, value)
+        self.onChange()
+
+
+class DeviceInfo:
+
+    def __init__(self, serial: str, index: int):
+        self.serial = serial
+        self.index = index
+
+    def GetSerialNumber(self):
+        return self.serial
+
+    def GetModelName(self):
+        return 'FC4D Simulator'
+
+    def GetDeviceVersion(self):
+        return '1'
+
+    def GetFullName(self):
+        # A differently configured simulator counts as a different device
+        return ('sim://' + self.serial + '/' + str(settings['width']) + 'x' + str(settings['height']) + '-' +
+                settings['pixelFormat'] + '/' + str(settings['replay']) + ('/binning' if settings['binning'] else ''))
+
+
+class TlFactory:
+    instance = None
+
+    @staticmethod
+    def GetInstance():
+        if TlFactory.instance is None:
+            TlFactory.instance = TlFactory()
+        return TlFactory.instance
+
+    def EnumerateDevices(self):
+        devices = []
+        for i in range(settings['devices']):
+            serial = settings['serial'] + str(i + 1).zfill(4)
+            devices.append(DeviceInfo(serial, i))
+        return devices
+
+    def CreateFirstDevice(self):
+        devices = self.EnumerateDevices()
+        if len(devices) == 0:
+            raise RuntimeException('No device is available')
+        return devices[0]
+
+    def CreateDevice(self, info: DeviceInfo):
+        return info
+
+
+class ImageFormatConverter:
+
+    def __init__(self):
+        self.OutputPixelFormat = PixelType_Mono16
+
+    def SetOutputPixelFormat(self, fmt):
+        if fmt not in converterFormats:
+            raise RuntimeException('Output format ' + str(fmt) + ' not supported')
+        self.OutputPixelFormat = fmt
+
+
+class GrabResult:
+
+    def __init__(self, array, timestamp: int, image_number: int, skipped: int, payload=None):
+        self.Array = array
+        self.payload = payload
+        self.TimeStamp = timestamp
+        self.ImageNumber = image_number
+        self.skipped = skipped
+
+    def GrabSucceeded(self):
+        return True
+
+    def GetArray(self):
+        return self.Array
+
+    @contextmanager
+    def GetArrayZeroCopy(self, raw=False):
+        if raw and self.payload is not None:
+            view = np.frombuffer(self.payload, dtype='uint8')
+        else:
+            view = self.Array.view()
+        view.flags.writeable = False
+        yield view
+        # pypylon refuses to leave the context while anything beyond the with target still refers to the view,
+        # here that and this frame's own name plus getrefcount's argument
+        if sys.getrefcount(view) > 3:
+            raise RuntimeError('Please remove any references to the array before leaving context manager scope')
+
+    def GetBuffer(self):
+        # Raw payload as it came over the link, packed for Mono10p/Mono12p
+        if self.payload is not None:
+            return self.payload
+        return self.Array.tobytes()
+
+    def GetNumberOfSkippedImages(self):
+        return self.skipped
+
+    def Release(self):
+        self.Array = None
+        self.payload = None
+
+
+def synthesise(width: int, height: int, bits: int, count: int, seed=0):
+    # A slowly drifting bright blob on a dim background with shot-like noise
+    rng = np.random.default_rng(seed)
+    full = (1 << bits) - 1
+    d_type = 'uint8' if bits <= 8 else 'uint16'
+    y = np.linspace(-1, 1, height, dtype='float32')[:, None]
+    x = np.linspace(-1, 1, width, dtype='float32')[None, :]
+    bank = np.empty((count, height, width), dtype=d_type)
+    for i in range(count):
+        phase = 2 * np.pi * i / count
+        blob = np.exp(-((x - 0.4 * np.cos(phase)) ** 2 + (y - 0.4 * np.sin(phase)) ** 2) / 0.08)
+        img = full * (0.1 + 0.7 * blob) + rng.normal(0, 0.01 * full, (height, width))
+        np.clip(img, 0, full, out=img)
+        bank[i] = img
+    return bank
+
+
+class InstantCamera:
+
+    def __init__(self, info: DeviceInfo = None):
+        self.info = info if info is not None else TlFactory.GetInstance().CreateFirstDevice()
+        self.WidthMax = Node(settings['width'], writable=False)
+        self.HeightMax = Node(settings['height'], writable=False)
+        self.Width = SizeNode(settings['width'], self.WidthMax)
+        self.Height = SizeNode(settings['height'], self.HeightMax)
+        self.PixelFormat = Node(settings['pixelFormat'], list(formatBits.keys()))
+        self.AcquisitionFrameRate = Node(settings['fps'])
+        self.DeviceFirmwareVersion = Node('FC4D-SIM 1.0', writable=False)
+        if settings['binning'] and settings['replay'] is None:
+            # Binned frames are synthesised at the binned size
+            self.BinningHorizontal = BinningNode(self.apply_binning)
+            self.BinningVertical = BinningNode(self.apply_binning)
+        self.opened = False
+        self.grabbing = False
+        self.strategy = GrabStrategy_OneByOne
+        self.frames = None
+        self.offsets = None
+        self.loopTime = 0
+        self.packed = None
+        self.bankFormat = None
+        self.period = 0
+        self.start = 0
+        self.imageNumber = 0
+
+    def GetDeviceInfo(self):
+        return self.info
+
+    def apply_binning(self):
+        # Like a Basler camera: the maximum follows the binning, the size only shrinks to fit and stays small
+        # when the binning comes down again
+        self.WidthMax.Value = settings['width'] // self.BinningHorizontal()
+        self.HeightMax.Value = settings['height'] // self.BinningVertical()
+        self.Width.Value = min(self.Width(), self.WidthMax())
+        self.Height.Value = min(self.Height(), self.HeightMax())
+
+    def set_size(self, height: int, width: int):
+        self.Height.Value = self.HeightMax.Value = height
+        self.Width.Value = self.WidthMax.Value = width
+
+    def Open(self):
+        if settings['replay'] is not None and self.frames is None:
+            self.load_frames()
+        self.opened = True
+
+    def Close(self):
+        self.StopGrabbing()
+        self.opened = False
+
+    def IsOpen(self):
+        return self.opened
+
+    def IsGrabbing(self):
+        return self.grabbing
+
+    def load_frames(self):
+        self.offsets = None
+        if settings['replay'] is not None and os.path.isdir(settings['replay']):
+            self.frames = Recording(settings['replay'])
+            self.set_size(*self.frames.shape[1:])
+            self.PixelFormat.Value = self.frames.meta.get('pixelFormat', self.PixelFormat.Value)
+            host_times = self.frames.index['hostTime']
+            if len(host_times) > 1:
+                # Frame n of a loop is due offsets[n] after the loop starts; a loop lasts one mean frame longer
+                # than the recording
+                self.offsets = ((host_times - host_times[0]) * 1e9).astype('int64')
+                self.loopTime = int(self.offsets[-1] * len(host_times) / (len(host_times) - 1))
+                if self.loopTime <= 0:
+                    self.offsets = None
+        elif settings['replay'] is not None:
+            self.frames = np.load(settings['replay'], mmap_mode='r')
+            self.set_size(*self.frames.shape[1:])
+        else:
+            self.frames = synthesise(self.Width(), self.Height(), formatBits[self.PixelFormat()], settings['bank'],
+                                     self.info.index)
+        self.bankFormat = self.PixelFormat()
+        self.packed = None
+
+    def StartGrabbing(self, strategy=GrabStrategy_OneByOne):
+        if (self.frames is None or self.frames.shape[1:] != (self.Height(), self.Width()) or
+                self.bankFormat != self.PixelFormat()):
+            self.load_frames()
+        if self.PixelFormat() in PACKED_BITS:
+            if self.packed is None:
+                self.packed = [pack(frame, self.PixelFormat()).tobytes() for frame in self.frames]
+        else:
+            self.packed = None
+        self.strategy = strategy
+        self.period = int(1e9 / self.AcquisitionFrameRate())
+        self.start = perf_counter_ns()
+        self.imageNumber = 0
+        self.grabbing = True
+        logging.info('Simulated camera ' + self.info.GetSerialNumber() + ' streaming ' + str(self.Width()) + 'x' +
+                     str(self.Height()) + ' ' + self.PixelFormat() + ' @ ' + str(self.AcquisitionFrameRate()))
+
+    def StopGrabbing(self):
+        self.grabbing = False
+
+    def paced(self):
+        return settings['replaySpeed'] != 'max' or settings['replay'] is None
+
+    def due(self, n: int):
+        # When image n leaves the simulated sensor, on the perf_counter_ns clock
+        if self.offsets is not None and settings['replaySpeed'] == 'original':
+            loop, i = divmod(n, len(self.offsets))
+            return self.start + loop * self.loopTime + int(self.offsets[i])
+        return self.start + n * self.period
+
+    def RetrieveResult(self, timeout_ms: int, handling=TimeoutHandling_ThrowException):
+        if not self.grabbing:
+            raise RuntimeException('Camera is not grabbing')
+        # Frames arrive on a fixed sensor clock; with LatestImageOnly the ones we were too late for are skipped
+        now = perf_counter_ns()
+        if not self.paced():
+            self.imageNumber += 1
+            index = self.imageNumber % len(self.frames)
+            return GrabResult(self.frames[index], now, self.imageNumber, 0,
+                              self.packed[index] if self.packed is not None else None)
+        due = self.due(self.imageNumber + 1)
+        skipped = 0
+        if self.strategy == GrabStrategy_LatestImageOnly:
+            while self.due(self.imageNumber + 2) < now:
+                self.imageNumber += 1
+                skipped += 1
+            due = self.due(self.imageNumber + 1)
+        if due - now > timeout_ms * 1000000:
+            sleep(timeout_ms / 1000)
+            if handling == TimeoutHandling_ThrowException:
+                raise TimeoutException('Grab timed out')
+            return None
+        if due > now:
+            sleep((due - now) / 1e9)
+        self.imageNumber += 1
+        index = self.imageNumber % len(self.frames)
+        return GrabResult(self.frames[index], due, self.imageNumber, int(skipped),
+                          self.packed[index] if self.packed is not None else None)
@@ -0,0 +1,34 @@
+import numpy as np
+from time import perf_counter_ns
+
+clock = perf_counter_ns
+
+# Log2 spaced latency buckets from 1 us to ~1 s, in ns
+BUCKETS = np.concatenate(([0], 1000 * 2 ** np.arange(21, dtype='int64')))
+
+
+class RollingStat:
+    # Keeps the last `window` samples in a preallocated array; add() is the only thing on the hot path and
+    # summary() turns the window into percentiles and a histogram on request
+
+    def __init__(self, window=1024):
+        self.samples = np.zeros(window, dtype='int64')
+        self.index = 0
+        self.count = 0
+
+    def add(self, value):
+        self.samples[self.index] = value
+        self.index = (self.index + 1) % len(self.samples)
+        self.count += 1
+
+    def summary(self, scale=1000.0, hist=True):
+        n = min(self.count, len(self.samples))
+        if n == 0:
+            return {'count': self.count}
+        window = self.samples[:n]
+        p50, p99 = np.percentile(window, [50, 99])
+        res = {'count': self.count, 'mean': float(window.mean()) / scale, 'p50': float(p50) / scale,
+               'p99': float(p99) / scale, 'max': float(window.max()) / scale}
+        if hist:
+            res['hist'] = np.histogram(window, np.append(BUCKETS, np.iinfo('int64').max))[0].tolist()
+        return res
@@ -1,39 +1,58 @@
+import logging
 from tkinter import *
 from PIL import Image, ImageTk
-from os.path import realpath
-import numpy as np
-from pypylon import pylon as py
+from os.path import realpath, dirname
+import socket
 from threading import Thread, Event
+from time import perf_counter
 # from multiprocessing import Process, Event as mpEvent
+import FC4D_SimCamera
+from FC4D_Display import DisplayMapper, sensor_bits
+from FC4D_Protocol import FrameNote, NotificationParser, parse_active_file
+from FC4D_SharedFrames import FrameRing
 
-pwd = realpath(__file__)
-pwd = pwd[:pwd.rindex('\\') + 1]
-
-resample = Image.BILINEAR
-# resample = Image.BICUBIC
-# resample = Image.LANCZOS
+pwd = dirname(realpath(__file__))
+# pypylon (or FC4D_SimCamera) is only imported in __main__ when the GUI drives a camera itself
+py = None
 
 
 class Window(Frame):
 
-    def __init__(self, master=None):
+    def __init__(self, master=None, grabber_port=None, refresh=60.0, serial=None):
         Frame.__init__(self, master)
         self.master = master
+        self.grabberPort = grabber_port
+        self.serial = serial
+        self.sock = None
+        self.ring = None
         self.camera = None
         self.IFC = None
         self.camImg = None
+        self.camBuf = None
         self.imgWig = None
         self.capturing = False
         self.captureWorker = None
-        self.showWorker = None
         self.newFrame = Event()
-        self.oldW = self.winfo_width
-        self.oldH = self.winfo_height
-        self.iw = self.oldW
-        self.ih = self.oldH
+        self.frameImg = None
+        self.pollId = None
+        self.notifications = None
+        self.note = None
+        self.renderId = None
+        self.lastRender = 0.0
+        self.lastTime = 0
+        self.diffTimes = [0] * 10
+        self.frameCounter = 0
+        self.photo = None
+        self.ratio = None
+        self.framePeriod = 1 / refresh
+        self.oldW = 0
+        self.oldH = 0
+        self.iw = 0
+        self.ih = 0
         self.file = None
         self.edit = None
         self.resizePending = False
+        self.mapper = DisplayMapper()
         self.init_window()
 
 
@@ -42,6 +61,7 @@ class Window(Frame):
 
         self.pack(fill=BOTH, expand=1)
         self.configure(background='black')
+        self.bind('<Configure>', self.schedule_resize)
 
         master_menu = Menu(self.master)
         self.master.config(menu=master_menu)
@@ -52,9 +72,27 @@ class Window(Frame):
 
         self.edit = Menu(master_menu)
         self.edit.add_command(label='Stream Camera', command=self.stream_camera)
+        self.edit.add_separator()
+        self.edit.add_command(label='Auto Level', command=self.toggle_auto_level)
+        self.edit.add_command(label='Contrast +', command=lambda: self.mapper.set_contrast(self.mapper.contrast * 1.25))
+        self.edit.add_command(label='Contrast -', command=lambda: self.mapper.set_contrast(self.mapper.contrast / 1.25))
+        self.edit.add_command(label='Gamma +', command=lambda: self.mapper.set_gamma(self.mapper.gamma * 1.2))
+        self.edit.add_command(label='Gamma -', command=lambda: self.mapper.set_gamma(self.mapper.gamma / 1.2))
+        self.edit.add_command(label='Bin Preview', command=self.toggle_binning)
+        self.edit.add_command(label='Reset Levels', command=self.mapper.reset)
         master_menu.add_cascade(label='Image', menu=self.edit)
 
-        self.camera = py.InstantCamera(py.TlFactory.GetInstance().CreateFirstDevice())
+        if self.grabberPort is not None:
+            # Frames come from the CameraGrabber's shared ring, the camera stays free for everyone else
+            return
+        factory = py.TlFactory.GetInstance()
+        if self.serial is not None:
+            infos = [info for info in factory.EnumerateDevices() if info.GetSerialNumber() == self.serial]
+            if len(infos) == 0:
+                raise RuntimeError('Camera ' + self.serial + ' not found')
+            self.camera = py.InstantCamera(factory.CreateDevice(infos[0]))
+        else:
+            self.camera = py.InstantCamera(factory.CreateFirstDevice())
         self.IFC = py.ImageFormatConverter()
         self.IFC.SetOutputPixelFormat(py.PixelType_Mono16)
         # self.camera.Open()
@@ -66,19 +104,36 @@ class Window(Frame):
         # text = Label(self, text='Flat Cam 4 Dummies')
         # text.pack()
         if not self.capturing:
-            self.camera.Open()
-            self.camera.StartGrabbing(py.GrabStrategy_LatestImageOnly)
-            self.captureWorker = Thread(target=self.capture_frames)
-            self.showWorker = Thread(target=self.show_frames)
-            self.capturing = True
-            self.captureWorker.start()
-            self.showWorker.start()
+            if self.grabberPort is not None:
+                self.sock = socket.create_connection(('127.0.0.1', self.grabberPort))
+                cam = ':' + self.serial if self.serial is not None else ''
+                self.sock.sendall(('stream' + cam + '\nframedonotify' + cam + ':binary:latest\n').encode('utf-8'))
+                self.sock.setblocking(False)
+                self.notifications = NotificationParser()
+                self.lastTime = 0
+                # Notifications are read on the Tk main loop as they arrive, no thread and no polling
+                self.master.tk.createfilehandler(self.sock, READABLE, self.read_shared_frames)
+                self.capturing = True
+            else:
+                self.camera.Open()
+                self.camera.StartGrabbing(py.GrabStrategy_LatestImageOnly)
+                self.capturing = True
+                self.captureWorker = Thread(target=self.capture_frames)
+                self.captureWorker.start()
+                self.pollId = self.master.after(self.poll_ms(), self.poll_frame)
             self.edit.entryconfigure('Stream Camera', label='Stop Camera')
+        elif self.grabberPort is not None:
+            self.stop_shared_frames()
         else:
             self.capturing = False
             self.captureWorker.join(1)
             self.captureWorker = None
-            self.camera.Close()
+            if self.pollId is not None:
+                self.master.after_cancel(self.pollId)
+                self.pollId = None
+            self.newFrame.clear()
+            if self.camera is not None:
+                self.camera.Close()
             self.edit.entryconfigure('Stop Camera', label='Stream Camera')
 
     def capture_frames(self):
@@ -94,15 +149,22 @@ class Window(Frame):
             if grabResult.GrabSucceeded():
                 thisTime = grabResult.TimeStamp
                 if not self.newFrame.is_set():
-                    imgt = np.copy(grabResult.Array)
+                    # The mapper reads the grab buffer in place and writes its own reused 8 bit buffer; pypylon
+                    # raises if the zero copy view is still referenced when its context is left
+                    if hasattr(grabResult, 'GetArrayZeroCopy'):
+                        with grabResult.GetArrayZeroCopy() as raw:
+                            img = self.mapper.map(raw)
+                            del raw
+                    else:
+                        img = self.mapper.map(grabResult.Array)
                     grabResult.Release()
                     if lastTime > 0:
                         diffTimes[frameCounter] = thisTime - lastTime
                     lastTime = thisTime
                     frameCounter = (frameCounter + 1) % 10
                     if frameCounter == 9:
-                        print(10000000000 / sum(diffTimes))
-                    self.camImg = Image.fromarray((imgt[0::1, 0::1] / 16).astype('uint8'))
+                        logging.debug('Camera FPS: ' + str(10000000000 / sum(diffTimes)))
+                    self.frameImg = img
                     self.newFrame.set()
                 else:
                     grabResult.Release()
@@ -110,42 +172,107 @@ class Window(Frame):
                     lastTime = thisTime
                     frameCounter = (frameCounter + 1) % 10
                     if frameCounter == 9:
-                        print(10000000000 / sum(diffTimes))
+                        logging.debug('Camera FPS: ' + str(10000000000 / sum(diffTimes)))
         self.camera.StopGrabbing()
 
-    def show_frames(self):
-        while self.capturing:
-            if self.newFrame.wait(0.01):
-                ratio = self.camImg.width / self.camImg.height
-                if self.imgWig is None:
-                    mw, mh = (self.winfo_width(), self.winfo_height())
-                    self.oldW = mw
-                    self.oldH = mh
-                    if mw >= mh * ratio:
-                        self.ih = mh
-                        self.iw = round(mh * ratio)
-                    else:
-                        self.iw = mw
-                        self.ih = round(mw / ratio)
-                    self.camImg = ImageTk.PhotoImage(self.camImg.resize((self.iw, self.ih), resample))
-                    self.imgWig = Label(self, image=self.camImg)
-                    self.imgWig.place(relx=0.5, rely=0.5, width=self.iw, height=self.ih, anchor=CENTER)
-                else:
-                    mw, mh = (self.winfo_width(), self.winfo_height())
-                    if self.oldH != mh or self.oldW != mw:
-                        if mw >= mh * ratio:
-                            self.ih = mh
-                            self.iw = round(mh * ratio)
-                        else:
-                            self.iw = mw
-                            self.ih = round(mw / ratio)
-                        self.imgWig.place(relx=0.5, rely=0.5, width=self.iw, height=self.ih, anchor=CENTER)
-                        self.oldH = mh
-                        self.oldW = mw
-                    self.camImg = ImageTk.PhotoImage(self.camImg.resize((self.iw, self.ih), resample))
-                    self.imgWig.configure(image=self.camImg)
-                self.imgWig.image = self.camImg
-                self.newFrame.clear()
+    def read_shared_frames(self, _sock, _mask):
+        try:
+            data = self.sock.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if len(data) == 0:
+            logging.warning('CameraGrabber connection lost')
+            self.stop_shared_frames()
+            return
+        newest = None
+        for event in self.notifications.feed(data):
+            if isinstance(event, FrameNote):
+                newest = event
+            elif 'ActiveFile' in event:
+                fname, _h, _w, d_type, _slots, _camera = parse_active_file(event)
+                if self.ring is not None:
+                    self.ring.close()
+                self.ring = FrameRing(fname)
+                self.mapper.set_bits(sensor_bits(fname, d_type), d_type)
+        if newest is None or self.ring is None:
+            return
+        thisTime = newest.timestamp
+        if self.lastTime > 0:
+            self.diffTimes[self.frameCounter] = thisTime - self.lastTime
+            self.frameCounter = (self.frameCounter + 1) % 10
+            if self.frameCounter == 9:
+                logging.debug('Camera FPS: ' + str(10000000000 / sum(self.diffTimes)))
+        self.lastTime = thisTime
+        # Only the newest frame is drawn, at most once per display refresh
+        self.note = newest
+        if self.renderId is None:
+            wait = self.lastRender + self.framePeriod - perf_counter()
+            self.renderId = self.master.after(max(0, int(wait * 1000)), self.render_shared_frame)
+
+    def render_shared_frame(self):
+        self.renderId = None
+        self.lastRender = perf_counter()
+        seq = self.note.seq
+        # Convert straight out of the shared slot, then make sure the grabber did not reuse it meanwhile
+        frame = self.ring.view(seq)
+        if frame is None:
+            return
+        img = self.mapper.map(frame)
+        if self.ring.valid(seq):
+            self.render_frame(img)
+
+    def stop_shared_frames(self):
+        self.capturing = False
+        self.master.tk.deletefilehandler(self.sock)
+        if self.renderId is not None:
+            self.master.after_cancel(self.renderId)
+            self.renderId = None
+        try:
+            self.sock.send(b'framenonotify\n')
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self.sock = None
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+        self.edit.entryconfigure('Stop Camera', label='Stream Camera')
+
+    def poll_ms(self):
+        return max(1, int(self.framePeriod * 1000))
+
+    def poll_frame(self):
+        # Tk may only be touched from the main loop, so while the camera streams its capture thread just sets
+        # newFrame and this picks it up once per display refresh; until it does, the capture thread skips frames
+        if self.newFrame.is_set():
+            self.render_frame(self.frameImg)
+            self.newFrame.clear()
+        self.pollId = self.master.after(self.poll_ms(), self.poll_frame)
+
+    def render_frame(self, img):
+        h, w = self.mapper.shape
+        ratio = w / h
+        if self.photo is None or ratio != self.ratio:
+            self.ratio = ratio
+            self.resize()
+        # The mapper puts out frames at the photo's size; one mapped before a resize is dropped
+        if img.shape != (self.ih, self.iw):
+            return
+        if img is not self.camBuf:
+            # The mapper reuses its output buffer, so one image over it serves until the size changes
+            self.camBuf = img
+            self.camImg = Image.frombuffer('L', (img.shape[1], img.shape[0]), img, 'raw', 'L', 0, 1)
+        self.photo.paste(self.camImg)
+
+    def toggle_auto_level(self):
+        self.mapper.auto = not self.mapper.auto
+        self.mapper.frames = 0
+
+    def toggle_binning(self):
+        self.mapper.bin = not self.mapper.bin
 
     def schedule_resize(self, event):
         if self.resizePending:
@@ -154,30 +281,85 @@ class Window(Frame):
         self.master.after(50, self.resize)
 
     def resize(self):
-        iw, ih = self.owlOrig.size
+        self.resizePending = False
+        if self.ratio is None:
+            return
         mw, mh = (self.winfo_width(), self.winfo_height())
-        if mw <= mh * self.owlOrig.ratio:
-            resized = self.owlOrig.resize((mw, round((mw / iw) * ih)), resample)
+        if self.photo is not None and self.oldW == mw and self.oldH == mh:
+            return
+        self.oldW = mw
+        self.oldH = mh
+        if mw >= mh * self.ratio:
+            ih = mh
+            iw = round(mh * self.ratio)
         else:
-            resized = self.owlOrig.resize((round((mh / ih) * iw), mh), resample)
-        render = ImageTk.PhotoImage(resized)
-        self.owl.configure(image=render)
-        self.owl.image = render
-        self.resizePending = False
+            iw = mw
+            ih = round(mw / self.ratio)
+        iw = max(1, iw)
+        ih = max(1, ih)
+        if self.photo is None or (iw, ih) != (self.iw, self.ih):
+            self.iw = iw
+            self.ih = ih
+            self.photo = ImageTk.PhotoImage('L', (iw, ih))
+            if self.imgWig is None:
+                self.imgWig = Label(self, image=self.photo, borderwidth=0)
+            else:
+                self.imgWig.configure(image=self.photo)
+            self.imgWig.image = self.photo
+            self.imgWig.place(relx=0.5, rely=0.5, width=iw, height=ih, anchor=CENTER)
+            self.mapper.set_target((iw, ih))
 
     def client_exit(self):
         # Wrap-up code here
         self.master.destroy()
 
 
-root = Tk()
-root.geometry('640x480')
+if __name__ == '__main__':
+    import sys
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-l', '--log_level', help='Specify log verbosity')
+    parser.add_argument('-g', '--grabber', action='store_true',
+                        help='Show frames from a running CameraGrabber instead of opening the camera')
+    parser.add_argument('-p', '--port', type=lambda x: int(x, 0), default=0xFC4D,
+                        help='CameraGrabber port, or the Reconstructor port (0xFC4E) to show reconstructions')
+    parser.add_argument('-r', '--refresh', type=float, default=60.0, help='Display refresh rate to render at')
+    parser.add_argument('-s', '--serial', help='Serial number of the camera to show, the first one by default')
+    FC4D_SimCamera.add_arguments(parser)
+    args = parser.parse_args()
+    if args.log_level:
+        if 'critical' in args.log_level:
+            logging.basicConfig(level=logging.CRITICAL)
+        elif 'error' in args.log_level:
+            logging.basicConfig(level=logging.ERROR)
+        elif 'warning' in args.log_level:
+            logging.basicConfig(level=logging.WARNING)
+        elif 'info' in args.log_level:
+            logging.basicConfig(level=logging.INFO)
+        elif 'debug' in args.log_level:
+            logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.WARNING)
+
+    if args.simulate:
+        FC4D_SimCamera.configure_from_args(args)
+        py = FC4D_SimCamera
+    elif not args.grabber:
+        try:
+            from pypylon import pylon as py
+        except ImportError:
+            print('pypylon is not installed, use --simulate')
+            sys.exit(1)
+
+    root = Tk()
+    root.geometry('640x480')
 
-app = Window(root)
+    app = Window(root, args.port if args.grabber else None, args.refresh, args.serial)
 
-root.mainloop()
+    root.mainloop()
 
-if app.camera is not None:
-    app.camera.StopGrabbing()
-    app.camera.Close()
+    if app.camera is not None:
+        app.camera.StopGrabbing()
+        app.camera.Close()
 
@@ -0,0 +1,55 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from FC4D_Calibration import decompose
+from FC4D_Reconstructor import AdmmEngine
+
+
+def moving_sequence(frames=10, noise=20.0, seed=0):
+    # A two box scene drifting one column every third frame through a random separable system
+    rng = np.random.default_rng(seed)
+    phi_l = rng.random((128, 32))
+    phi_r = rng.random((160, 40))
+    scene = np.zeros((32, 40))
+    scene[5:20, 10:25] = 100
+    scene[22:30, 3:15] = 50
+    ys = [phi_l @ np.roll(scene, i // 3, 1) @ phi_r.T + rng.normal(0, noise, (128, 160)) for i in range(frames)]
+    return decompose(phi_l, phi_r), ys
+
+
+def iteration_counts(prior, tau, frames=30):
+    # Iterations per frame carrying the solution over, and restarting from the Tikhonov solution every frame
+    factors, ys = moving_sequence(frames)
+    kwargs = {} if tau is None else {'tau': tau}
+    warm = AdmmEngine(factors, prior=prior, **kwargs)
+    cold = AdmmEngine(factors, prior=prior, **kwargs)
+    warm_iterations = []
+    cold_iterations = []
+    for y in ys:
+        warm.process(y)
+        warm_iterations.append(warm.iterations)
+        cold.reset()
+        cold.process(y)
+        cold_iterations.append(cold.iterations)
+    return warm_iterations, cold_iterations
+
+
+@pytest.mark.parametrize('prior', ['tv', 'l1'])
+@pytest.mark.parametrize('tau', [None, 1e-3])
+def test_warm_start_needs_fewer_iterations_than_cold(prior, tau):
+    warm_iterations, cold_iterations = iteration_counts(prior, tau)
+    # The first frame starts cold in both
+    assert warm_iterations[0] == cold_iterations[0]
+    assert sum(warm_iterations[1:]) < 0.95 * sum(cold_iterations[1:])
+
+
+@pytest.mark.parametrize('prior', ['tv', 'l1'])
+def test_weak_prior_falls_back_to_cold_start(prior):
+    # At this tau the Tikhonov solution is the better start, so carrying over must cost next to nothing
+    warm_iterations, cold_iterations = iteration_counts(prior, 1e-5)
+    assert sum(warm_iterations[1:]) <= 1.05 * sum(cold_iterations[1:])